@@ -0,0 +1,86 @@
+from typing import List
+import argparse
+import itertools
+import json
+import timeit
+
+import torch
+
+from allennlp.data.tokenizers.token import Token
+from allennlp.data.vocabulary import Vocabulary
+from allennlp.modules.time_distributed import TimeDistributed
+from allennlp.modules.token_embedders.embedding import Embedding
+from ud2ccg.allennlp.data.afix_indexer import SingleIdTokenIndexer, get_prefix, get_suffix
+from ud2ccg.allennlp.nn.afix_embedding import AfixEmbedding
+
+
+def read_words(file_path: str) -> List[str]:
+    """
+    reads the words of a JSON lines file in the input format of Tree2treePredictor
+    """
+    with open(file_path) as f:
+        return [word for line in f if line.strip() for word in json.loads(line)['words']]
+
+
+def uncached_indices(tokens: List[Token], vocabulary: Vocabulary, namespace: str) -> List[List[int]]:
+    # afix_ids indexers before the cache, for both prefixes and suffixes
+    return [[vocabulary.get_token_index(afix, namespace) for afix in get_afix(token.text)]
+            for get_afix in [get_prefix, get_suffix] for token in tokens]
+
+
+def time_distributed_embedding(embedding: Embedding, token_afixes: torch.Tensor) -> torch.Tensor:
+    # AfixEmbedding.forward before the single lookup
+    batchsize, sentence_length, _ = token_afixes.size()
+    embedded = TimeDistributed(TimeDistributed(embedding))(token_afixes.unsqueeze(-1))
+    return embedded.view(batchsize, sentence_length, -1)
+
+
+def benchmark(file_path: str,
+              num_tokens: int = 100000,
+              batch_size: int = 32,
+              sentence_length: int = 30,
+              embedding_dim: int = 32,
+              repeat: int = 5) -> None:
+    words = read_words(file_path)
+    tokens = [Token(word) for word in itertools.islice(itertools.cycle(words), num_tokens)]
+    namespace = 'afixes'
+    vocabulary = Vocabulary()
+    # only the afixes of the first half of the words, so that some are unknown
+    for word in words[:len(words) // 2]:
+        for afix in get_prefix(word) + get_suffix(word):
+            vocabulary.add_token_to_namespace(afix, namespace)
+    indexers = [SingleIdTokenIndexer('prefix', namespace), SingleIdTokenIndexer('suffix', namespace)]
+
+    def cached_indices():
+        return [index for indexer in indexers
+                for index in indexer.tokens_to_indices(tokens, vocabulary, 'afixes')['afixes']]
+
+    assert cached_indices() == uncached_indices(tokens, vocabulary, namespace)
+    print(f'indexing {num_tokens} tokens ({len(set(words))} types), best of {repeat}:')
+    for name, function in [('uncached', lambda: uncached_indices(tokens, vocabulary, namespace)),
+                           ('cached', cached_indices)]:
+        print(f'  {name:>16}: {min(timeit.repeat(function, number=1, repeat=repeat)) * 1000:.1f} ms')
+
+    embedding = Embedding(vocabulary.get_vocab_size(namespace), embedding_dim)
+    afix_embedding = AfixEmbedding(embedding)
+    token_afixes = torch.randint(0, vocabulary.get_vocab_size(namespace), (batch_size, sentence_length, 4))
+    with torch.no_grad():
+        assert torch.equal(afix_embedding(token_afixes), time_distributed_embedding(embedding, token_afixes))
+        number = 1000
+        print(f'embedding a ({batch_size}, {sentence_length}, 4) batch, per call:')
+        for name, function in [('time distributed', lambda: time_distributed_embedding(embedding, token_afixes)),
+                               ('single lookup', lambda: afix_embedding(token_afixes))]:
+            seconds = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+            print(f'  {name:>16}: {seconds * 1e6:.1f} us')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('microbenchmark of the afix indexers and AfixEmbedding')
+    parser.add_argument('INPUT', nargs='?', default='geometry/geo-train.json',
+                        help='JSON lines file with "words"')
+    parser.add_argument('--num-tokens', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--sentence-length', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    benchmark(args.INPUT, args.num_tokens, args.batch_size, args.sentence_length, repeat=args.repeat)
@@ -1,4 +1,6 @@
-from typing import Dict, List
+from typing import Callable, Dict, List, Tuple
+import functools
+import weakref
 
 from overrides import overrides
 
@@ -27,6 +29,60 @@ def get_prefix(word):
             word[:4] if len(word) > 3 else OOR4]
 
 
+class AfixIdCache:
+    """
+    bounded LRU cache from words to the ids of their prefixes and suffixes in a namespace,
+    shared by the prefix and suffix indexers of the namespace (see afix_id_cache).
+    It is cleared when the vocabulary or the size of the namespace changes.
+    :param namespace: vocabulary namespace of the afixes
+    :param max_size: maximum number of words cached
+    """
+    def __init__(self, namespace: str, max_size: int = 100000) -> None:
+        self.namespace = namespace
+        self.max_size = max_size
+        self._vocabulary: weakref.ref = None
+        self._vocabulary_size = 0
+        self._lookup: Callable[[str], Tuple[List[int], List[int]]] = None
+
+    def get(self, vocabulary: Vocabulary, word: str) -> Tuple[List[int], List[int]]:
+        """
+        :return:
+            the ids of the prefixes and the suffixes of word
+        """
+        vocabulary_size = vocabulary.get_vocab_size(self.namespace)
+        if self._vocabulary is None or self._vocabulary() is not vocabulary \
+                or self._vocabulary_size != vocabulary_size:
+            self._vocabulary = weakref.ref(vocabulary)
+            self._vocabulary_size = vocabulary_size
+            self._lookup = functools.lru_cache(maxsize=self.max_size)(self._make_lookup(vocabulary))
+        return self._lookup(word)
+
+    def _make_lookup(self, vocabulary: Vocabulary) -> Callable[[str], Tuple[List[int], List[int]]]:
+        token_to_index = vocabulary.get_token_to_index_vocabulary(self.namespace)
+
+        def index(afix: str) -> int:
+            if afix in token_to_index:
+                return token_to_index[afix]
+            # unknown afixes
+            return vocabulary.get_token_index(afix, self.namespace)
+
+        def lookup(word: str) -> Tuple[List[int], List[int]]:
+            return [index(afix) for afix in get_prefix(word)], [index(afix) for afix in get_suffix(word)]
+        return lookup
+
+    def cache_info(self):
+        return self._lookup.cache_info() if self._lookup is not None else None
+
+
+_AFIX_ID_CACHES: Dict[str, AfixIdCache] = {}
+
+
+def afix_id_cache(namespace: str) -> AfixIdCache:
+    if namespace not in _AFIX_ID_CACHES:
+        _AFIX_ID_CACHES[namespace] = AfixIdCache(namespace)
+    return _AFIX_ID_CACHES[namespace]
+
+
 @TokenIndexer.register("afix_ids")
 class SingleIdTokenIndexer(TokenIndexer[List[int]]):
     def __init__(self,
@@ -39,6 +95,7 @@ class SingleIdTokenIndexer(TokenIndexer[List[int]]):
         else:
             self._get_afix = get_suffix
         self.namespace = namespace
+        self._cache = afix_id_cache(namespace)
 
     @overrides
     def count_vocab_items(self, token: Token, counter: Dict[str, Dict[str, int]]):
@@ -51,14 +108,9 @@ class SingleIdTokenIndexer(TokenIndexer[List[int]]):
                           tokens: List[Token],
                           vocabulary: Vocabulary,
                           index_name: str) -> Dict[str, List[List[int]]]:
-        indices: List[List[int]] = []
-
-        for token in tokens:
-            text = token.text
-            afixes = [vocabulary.get_token_index(afix, self.namespace)
-                      for afix in self._get_afix(text)]
-            indices.append(afixes)
-
+        # prefixes and suffixes of a word are cached together
+        position = 0 if self.afix_type == 'prefix' else 1
+        indices = [self._cache.get(vocabulary, token.text)[position] for token in tokens]
         return {index_name: indices}
 
     @overrides
@@ -0,0 +1,226 @@
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy
+
+
+class TreeArrays(NamedTuple):
+    """
+    array representation of a dependency tree, where node 0 is the root token.
+    heads: (n,) head index of each node, where heads[0] = -1
+    child_offsets, children: CSR-style children lists; the children of node i are
+        children[child_offsets[i]:child_offsets[i + 1]], in ascending order
+    depth: (n,) distance from the root
+    height: (n,) distance to the deepest leaf below the node
+    topdown_order: (n,) nodes in breadth-first order (parents before children)
+    bottomup_order: (n,) the reverse of topdown_order (children before parents)
+    """
+    heads: numpy.ndarray
+    child_offsets: numpy.ndarray
+    children: numpy.ndarray
+    depth: numpy.ndarray
+    height: numpy.ndarray
+    topdown_order: numpy.ndarray
+    bottomup_order: numpy.ndarray
+
+    def __len__(self) -> int:
+        return len(self.heads)
+
+
+def _check_heads(heads: numpy.ndarray) -> None:
+    if heads.ndim != 1 or len(heads) == 0:
+        raise ValueError(f'head indices must be a non-empty flat list, but got shape {heads.shape}')
+    roots = numpy.flatnonzero(heads < 0)
+    if len(roots) != 1 or roots[0] != 0:
+        raise ValueError('head indices must contain exactly one root at position 0 (whose head is -1), '
+                         f'but found roots at positions {roots.tolist()}')
+    out_of_range = numpy.flatnonzero(heads >= len(heads))
+    if len(out_of_range) > 0:
+        raise ValueError(f'head indices out of range at positions {out_of_range.tolist()} '
+                         f'(number of nodes: {len(heads)})')
+
+
+def expand_ranges(starts: numpy.ndarray, counts: numpy.ndarray) -> numpy.ndarray:
+    """
+    concatenation of numpy.arange(start, start + count) for each (start, count)
+    """
+    total = counts.sum()
+    return numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(total)
+
+
+def build_tree_arrays(head_indices: Union[Sequence[int], numpy.ndarray]) -> TreeArrays:
+    """
+    reads list of head indices and return TreeArrays object
+    representing dependency tree encoded in the list, in O(n) without recursion.
+    :param head_indices: heads indices where lst[0] = -1
+    :return:
+    """
+    heads = numpy.asarray(head_indices, dtype=numpy.int64)
+    _check_heads(heads)
+    num_nodes = len(heads)
+
+    # stable sort on 16-bit keys is a radix sort
+    key_type = numpy.uint16 if num_nodes <= numpy.iinfo(numpy.uint16).max else numpy.int64
+    children = numpy.argsort(heads[1:].astype(key_type), kind='stable') + 1
+    child_offsets = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(heads[1:], minlength=num_nodes), out=child_offsets[1:])
+
+    depth = numpy.full(num_nodes, -1, dtype=numpy.int64)
+    depth[0] = 0
+    levels: List[numpy.ndarray] = [numpy.zeros(1, dtype=numpy.int64)]
+    while True:
+        frontier = levels[-1]
+        starts = child_offsets[frontier]
+        counts = child_offsets[frontier + 1] - starts
+        if counts.sum() == 0:
+            break
+        frontier = children[expand_ranges(starts, counts)]
+        depth[frontier] = len(levels)
+        levels.append(frontier)
+
+    unreachable = numpy.flatnonzero(depth < 0)
+    if len(unreachable) > 0:
+        raise ValueError('head indices contain a cycle: nodes '
+                         f'{unreachable.tolist()} are not reachable from the root')
+
+    height = numpy.zeros(num_nodes, dtype=numpy.int64)
+    for level in reversed(levels[1:]):
+        numpy.maximum.at(height, heads[level], height[level] + 1)
+
+    topdown_order = numpy.concatenate(levels)
+    return TreeArrays(heads=heads,
+                      child_offsets=child_offsets,
+                      children=children,
+                      depth=depth,
+                      height=height,
+                      topdown_order=topdown_order,
+                      bottomup_order=topdown_order[::-1].copy())
+
+
+def _levels(tree: TreeArrays) -> List[numpy.ndarray]:
+    # topdown_order is sorted by depth
+    boundaries = numpy.flatnonzero(numpy.diff(tree.depth[tree.topdown_order])) + 1
+    return numpy.split(tree.topdown_order, boundaries)
+
+
+def preorder_and_subtree_sizes(tree: TreeArrays) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    :return:
+        preorder: (n,) position of each node in the depth-first preorder, visiting children in ascending order
+        size: (n,) number of nodes in the subtree of each node
+    """
+    num_nodes = len(tree)
+    levels = _levels(tree)
+    size = numpy.ones(num_nodes, dtype=numpy.int64)
+    for level in reversed(levels[1:]):
+        numpy.add.at(size, tree.heads[level], size[level])
+
+    # a child comes after its parent and the subtrees of its preceding siblings
+    child_sizes = numpy.concatenate([[0], numpy.cumsum(size[tree.children])])
+    sibling_start = tree.child_offsets[tree.heads[tree.children]]
+    offset = numpy.zeros(num_nodes, dtype=numpy.int64)
+    offset[tree.children] = 1 + child_sizes[:-1] - child_sizes[sibling_start]
+    preorder = numpy.zeros(num_nodes, dtype=numpy.int64)
+    for level in levels[1:]:
+        preorder[level] = preorder[tree.heads[level]] + offset[level]
+    return preorder, size
+
+
+class LCAIndex(NamedTuple):
+    """
+    Euler tour of a tree with a sparse table for range minimum queries on the depths along it.
+    euler: (2n - 1,) nodes in the order visited by the Euler tour
+    first: (n,) position of the first visit of each node in euler
+    table: (log2(2n - 1) + 1, 2n - 1), where table[k, i] is the position of the shallowest node
+        in euler[i:i + 2 ** k] (clipped at the end)
+    """
+    euler: numpy.ndarray
+    first: numpy.ndarray
+    table: numpy.ndarray
+
+
+def build_lca_index(tree: TreeArrays) -> LCAIndex:
+    """
+    builds LCAIndex in O(n log n) time, vectorized except for loops over tree levels and table rows.
+    """
+    preorder, size = preorder_and_subtree_sizes(tree)
+    # when a node is first visited, the tour has gone down preorder and up preorder - depth edges
+    first = 2 * preorder - tree.depth
+    euler = numpy.empty(2 * len(tree) - 1, dtype=numpy.int64)
+    euler[first] = numpy.arange(len(tree))
+    # returns to the parent after visiting each subtree
+    euler[first[1:] + 2 * size[1:] - 1] = tree.heads[1:]
+
+    euler_depth = tree.depth[euler]
+    length = len(euler)
+    rows = [numpy.arange(length)]
+    span = 1
+    while 2 * span <= length:
+        previous = rows[-1]
+        right = numpy.minimum(numpy.arange(length) + span, length - 1)
+        candidates = previous[right]
+        rows.append(numpy.where(euler_depth[candidates] < euler_depth[previous], candidates, previous))
+        span *= 2
+    return LCAIndex(euler=euler, first=first, table=numpy.stack(rows))
+
+
+def least_common_ancestors(index: LCAIndex, us: numpy.ndarray, vs: numpy.ndarray) -> numpy.ndarray:
+    """
+    :return:
+        the least common ancestor of each pair of nodes us[i] and vs[i], in O(1) per pair
+    """
+    left = numpy.minimum(index.first[us], index.first[vs])
+    right = numpy.maximum(index.first[us], index.first[vs])
+    # floor(log2(right - left + 1)), exactly
+    k = numpy.frexp(right - left + 1)[1] - 1
+    left_minimum = index.euler[index.table[k, left]]
+    right_minimum = index.euler[index.table[k, right - (1 << k) + 1]]
+    # the first visit of a node comes before those of its descendants
+    return numpy.where(index.first[left_minimum] <= index.first[right_minimum], left_minimum, right_minimum)
+
+
+MAX_ANCESTOR_OFFSET = 5
+MAX_PATH_LENGTH = 4
+
+
+def _adjacent_ancestors(ud_head_indices: Sequence[int],
+                        tree: Optional[TreeArrays]) -> Tuple[TreeArrays, numpy.ndarray]:
+    if tree is None:
+        tree = build_tree_arrays([-1] + list(ud_head_indices))
+    tokens = numpy.arange(1, len(tree) - 1)
+    return tree, least_common_ancestors(build_lca_index(tree), tokens, tokens + 1)
+
+
+def get_least_common_ancestor(ud_head_indices: Sequence[int], tree: Optional[TreeArrays] = None) -> List[str]:
+    """
+    labels each token with the position of the least common ancestor of the token and the next one,
+    relative to the token: "0" (the token itself), "1" (the next token), other offsets clipped
+    to +-MAX_ANCESTOR_OFFSET (e.g. "-5" for 5 or more tokens to the left), or "root";
+    the last token is labeled "EOS".
+    :param ud_head_indices: (n,) head indices of the tokens, where 0 is the root
+    :param tree: build_tree_arrays([-1] + ud_head_indices), if already computed
+    :return:
+        (n,) labels
+    """
+    tree, ancestors = _adjacent_ancestors(ud_head_indices, tree)
+    offsets = numpy.clip(ancestors - numpy.arange(1, len(tree) - 1), -MAX_ANCESTOR_OFFSET, MAX_ANCESTOR_OFFSET)
+    labels = numpy.where(ancestors == 0, 'root', offsets.astype(str))
+    return labels.tolist() + ['EOS']
+
+
+def dependency_path_pattern(ud_head_indices: Sequence[int], tree: Optional[TreeArrays] = None) -> List[str]:
+    """
+    labels each token with the shape of the dependency path from the token to the next one,
+    as "<up>/<down>", the numbers of arcs from the token up to their least common ancestor
+    and from there down to the next token, each clipped to MAX_PATH_LENGTH;
+    the last token is labeled "EOS".
+    :param ud_head_indices: (n,) head indices of the tokens, where 0 is the root
+    :param tree: build_tree_arrays([-1] + ud_head_indices), if already computed
+    :return:
+        (n,) labels
+    """
+    tree, ancestors = _adjacent_ancestors(ud_head_indices, tree)
+    tokens = numpy.arange(1, len(tree) - 1)
+    up = numpy.minimum(tree.depth[tokens] - tree.depth[ancestors], MAX_PATH_LENGTH).astype(str)
+    down = numpy.minimum(tree.depth[tokens + 1] - tree.depth[ancestors], MAX_PATH_LENGTH).astype(str)
+    labels = numpy.char.add(numpy.char.add(up, '/'), down) if len(tokens) > 0 else up
+    return labels.tolist() + ['EOS']
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List, NamedTuple, Tuple
 
 import numpy
 import torch
@@ -7,15 +7,28 @@ from overrides import overrides
 from allennlp.data.fields.field import Field
 
 
+class UnpaddedArray(NamedTuple):
+    """
+    IntArrayField.as_tensor output, padded only when the batch is collated in batch_tensors
+    array: the array of the field (not copied)
+    shape: the shape to which it is padded
+    """
+    array: numpy.ndarray
+    shape: Tuple[int, ...]
+
+
 class IntArrayField(Field[numpy.ndarray]):
     """
     A class representing an array, which could have arbitrary dimensions.
     A batch of these arrays are padded to the max dimension length in the batch
     for each dimension.
+    The padding is done for the whole batch at once in batch_tensors,
+    which optionally allocates the batch in pinned memory for faster copies to GPU.
     """
-    def __init__(self, array: numpy.ndarray, padding_value: int = 0) -> None:
+    def __init__(self, array: numpy.ndarray, padding_value: int = 0, pin_memory: bool = False) -> None:
         self.array = array
         self.padding_value = padding_value
+        self.pin_memory = pin_memory
 
     @overrides
     def get_padding_lengths(self) -> Dict[str, int]:
@@ -23,28 +36,36 @@ class IntArrayField(Field[numpy.ndarray]):
                 for i, shape in enumerate(self.array.shape)}
 
     @overrides
-    def as_tensor(self, padding_lengths: Dict[str, int]) -> torch.Tensor:
-        max_shape = [padding_lengths["dimension_{}".format(i)]
-                     for i in range(len(padding_lengths))]
-
-        # Convert explicitly to an ndarray just in case it's an scalar (it'd end up not being an ndarray otherwise)
-        return_array = numpy.asarray(numpy.ones(max_shape, "int32") * self.padding_value)
-
-        # If the tensor has a different shape from the largest tensor, pad dimensions with zeros to
-        # form the right shaped list of slices for insertion into the final tensor.
-        slicing_shape = list(self.array.shape)
-        if len(self.array.shape) < len(max_shape):
-            slicing_shape = slicing_shape + [0 for _ in range(len(max_shape) - len(self.array.shape))]
-        slices = tuple([slice(0, x) for x in slicing_shape])
-        return_array[slices] = self.array
-        tensor = torch.from_numpy(return_array)
-        return tensor
+    def as_tensor(self, padding_lengths: Dict[str, int]) -> UnpaddedArray:  # type: ignore
+        max_shape = tuple(padding_lengths["dimension_{}".format(i)]
+                          for i in range(len(padding_lengths)))
+        return UnpaddedArray(self.array, max_shape)
+
+    @overrides
+    def batch_tensors(self, tensor_list: List[UnpaddedArray]) -> torch.Tensor:  # type: ignore
+        shape = (len(tensor_list),) + tensor_list[0].shape
+        result = torch.empty(shape, dtype=torch.int32, pin_memory=self.pin_memory and torch.cuda.is_available())
+        result_array = result.numpy()
+        result_array.fill(self.padding_value)
+        arrays = [numpy.asarray(array) for array, _ in tensor_list]
+        if len(shape) == 2 and all(array.ndim == 1 for array in arrays):
+            # fill the whole batch with a single copy
+            lengths = numpy.array([len(array) for array in arrays])
+            result_array[numpy.arange(shape[1]) < lengths[:, None]] = numpy.concatenate(arrays)
+            return result
+        for row, array in zip(result_array, arrays):
+            # If the tensor has a different shape from the largest tensor, pad dimensions with zeros to
+            # form the right shaped list of slices for insertion into the final tensor.
+            slicing_shape = list(array.shape) + [0] * (len(shape) - 1 - array.ndim)
+            row[tuple(slice(0, x) for x in slicing_shape)] = array
+        return result
 
     @overrides
     def empty_field(self):  # pylint: disable=no-self-use
         # Pass the padding_value, so that any outer field, e.g., `ListField[ArrayField]` uses the
         # same padding_value in the padded ArrayFields
-        return IntArrayField(numpy.array([], dtype="int32"), padding_value=self.padding_value)
+        return IntArrayField(numpy.array([], dtype="int32"), padding_value=self.padding_value,
+                             pin_memory=self.pin_memory)
 
     def __str__(self) -> str:
         return f"ArrayField with shape: {self.array.shape}."
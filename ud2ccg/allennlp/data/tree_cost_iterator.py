@@ -0,0 +1,191 @@
+from typing import Iterable, List, NamedTuple, Optional
+import logging
+import random
+
+import numpy
+from overrides import overrides
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.data.dataset import Batch
+from allennlp.data.instance import Instance
+from allennlp.data.iterators.data_iterator import DataIterator
+from ud2ccg.allennlp.data.dependency_tree import build_tree_arrays
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class TreeCost(NamedTuple):
+    """
+    length: number of nodes including the root token, i.e. the padded length seen by the model
+    height: height of the tree, i.e. the number of levels of each tree LSTM pass minus one
+    fanout: maximum number of children of a node
+    """
+    length: int
+    height: int
+    fanout: int
+
+
+def tree_cost(instance: Instance) -> TreeCost:
+    """
+    reads the UD tree of a Tree2TreeDatasetReader instance
+    """
+    heads = instance.fields['ud_head_index_field'].array
+    length = len(heads)
+    if 'ud_height_field' in instance.fields:
+        height = int(instance.fields['ud_height_field'].array.max())
+    else:
+        height = int(build_tree_arrays(heads).height[0])
+    fanout = int(numpy.bincount(heads[1:], minlength=length).max()) if length > 1 else 0
+    return TreeCost(length, height, fanout)
+
+
+def group_by_tree_cost(costs: List[TreeCost],
+                       max_nodes: int,
+                       max_arc_cells: Optional[int] = None,
+                       max_instances: Optional[int] = None,
+                       length_weight: float = 1.0,
+                       height_weight: float = 4.0,
+                       fanout_weight: float = 1.0,
+                       padding_noise: float = 0.0) -> List[List[int]]:
+    """
+    sorts instances by the weighted sum of their length, height and fanout,
+    and cuts the sorted list into batches so that every batch fits in the budgets.
+    An instance that alone exceeds the budgets makes a batch on its own.
+    :param costs: TreeCost of each instance
+    :param max_nodes: maximum of batch size * padded length
+    :param max_arc_cells: maximum of batch size * padded length ** 2, i.e. the size of the arc scores
+    :param max_instances: maximum number of instances in a batch
+    :param padding_noise: the sort keys are multiplied by a random value in [1 - noise, 1 + noise]
+    :return:
+        lists of indices into costs
+    """
+    if not costs:
+        return []
+    array = numpy.array(costs, dtype=numpy.float64)
+    keys = array @ numpy.array([length_weight, height_weight, fanout_weight])
+    if padding_noise > 0:
+        keys *= numpy.random.uniform(1 - padding_noise, 1 + padding_noise, len(keys))
+    # ties are broken by length, so that similar lengths stay together
+    order = numpy.lexsort((array[:, 0], keys))
+
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    max_length = 0
+    for index in order.tolist():
+        length = max(max_length, costs[index].length)
+        size = len(batch) + 1
+        if batch and (size * length > max_nodes
+                      or (max_arc_cells is not None and size * length ** 2 > max_arc_cells)
+                      or (max_instances is not None and size > max_instances)):
+            batches.append(batch)
+            batch, length = [], costs[index].length
+        batch.append(index)
+        max_length = length
+    batches.append(batch)
+    return batches
+
+
+class PaddingStats(NamedTuple):
+    nodes: float
+    arc_cells: float
+    levels: float
+
+
+def padding_stats(costs: List[TreeCost], batches: List[List[int]]) -> PaddingStats:
+    """
+    fractions of padding in the node states, in the arc scores and in the tree levels
+    (where a batch runs as many levels as its highest tree), when costs are grouped into batches.
+    """
+    used, padded = numpy.zeros(3), numpy.zeros(3)
+    for batch in batches:
+        batch_costs = numpy.array([costs[index] for index in batch])
+        lengths, heights = batch_costs[:, 0], batch_costs[:, 1] + 1
+        used += [lengths.sum(), (lengths ** 2).sum(), heights.sum()]
+        padded += len(batch) * numpy.array([lengths.max(), lengths.max() ** 2, heights.max()])
+    return PaddingStats(*(1 - used / numpy.maximum(padded, 1)))
+
+
+@DataIterator.register("tree_cost_bucket")
+class TreeCostBucketIterator(DataIterator):
+    """
+    bucketing iterator for Tree2TreeDatasetReader instances, whose batches are filled
+    up to a budget of nodes (and of arc score cells) rather than to a fixed number of instances.
+    The instances are sorted by a weighted sum of the sentence length, the tree height and the fanout,
+    because the tree encoder runs one step per tree level, while the arc attention is quadratic in length.
+    The padding of the batches is logged along with that of batches of the same sizes in the input order.
+    :param max_nodes: maximum of batch size * (sentence length + 1)
+    :param max_arc_cells: maximum of batch size * (sentence length + 1) ** 2
+    :param length_weight: weight of the sentence length in the sort key
+    :param height_weight: weight of the tree height in the sort key
+    :param fanout_weight: weight of the maximum fanout in the sort key
+    :param padding_noise: relative noise added to the sort keys, so that batches vary between epochs
+    :param biggest_batch_first: put the batch with the most nodes first, to fail early on OOM
+    :param batch_size: maximum number of instances in a batch
+    """
+    def __init__(self,
+                 max_nodes: int = 4096,
+                 max_arc_cells: int = None,
+                 length_weight: float = 1.0,
+                 height_weight: float = 4.0,
+                 fanout_weight: float = 1.0,
+                 padding_noise: float = 0.1,
+                 biggest_batch_first: bool = False,
+                 batch_size: int = 256,
+                 instances_per_epoch: int = None,
+                 max_instances_in_memory: int = None,
+                 cache_instances: bool = False,
+                 track_epoch: bool = False) -> None:
+        if max_nodes <= 0:
+            raise ConfigurationError(f'max_nodes must be positive, but got {max_nodes}')
+        super().__init__(cache_instances=cache_instances,
+                         track_epoch=track_epoch,
+                         batch_size=batch_size,
+                         instances_per_epoch=instances_per_epoch,
+                         max_instances_in_memory=max_instances_in_memory)
+        self._max_nodes = max_nodes
+        self._max_arc_cells = max_arc_cells
+        self._length_weight = length_weight
+        self._height_weight = height_weight
+        self._fanout_weight = fanout_weight
+        self._padding_noise = padding_noise
+        self._biggest_batch_first = biggest_batch_first
+
+    @overrides
+    def _create_batches(self, instances: Iterable[Instance], shuffle: bool) -> Iterable[Batch]:
+        for instance_list in self._memory_sized_lists(instances):
+            costs = [tree_cost(instance) for instance in instance_list]
+            batches = group_by_tree_cost(costs,
+                                         self._max_nodes,
+                                         max_arc_cells=self._max_arc_cells,
+                                         max_instances=self._batch_size,
+                                         length_weight=self._length_weight,
+                                         height_weight=self._height_weight,
+                                         fanout_weight=self._fanout_weight,
+                                         padding_noise=self._padding_noise)
+            self._log_padding(costs, batches)
+
+            if self._biggest_batch_first and len(batches) > 1:
+                biggest = max(range(len(batches)),
+                              key=lambda i: len(batches[i]) * max(costs[j].length for j in batches[i]))
+                first = batches.pop(biggest)
+                if shuffle:
+                    random.shuffle(batches)
+                batches.insert(0, first)
+            elif shuffle:
+                random.shuffle(batches)
+
+            for batch in batches:
+                yield Batch([instance_list[index] for index in batch])
+
+    @staticmethod
+    def _log_padding(costs: List[TreeCost], batches: List[List[int]]) -> None:
+        stats = padding_stats(costs, batches)
+        # batches of the same sizes, taken in the input order
+        offsets = numpy.cumsum([0] + [len(batch) for batch in batches])
+        baseline = padding_stats(costs, [list(range(start, end)) for start, end in zip(offsets, offsets[1:])])
+        logger.info('%d instances in %d batches; padding of nodes: %.1f%% (%.1f%% in input order), '
+                    'arc scores: %.1f%% (%.1f%%), tree levels: %.1f%% (%.1f%%)',
+                    len(costs), len(batches),
+                    100 * stats.nodes, 100 * baseline.nodes,
+                    100 * stats.arc_cells, 100 * baseline.arc_cells,
+                    100 * stats.levels, 100 * baseline.levels)
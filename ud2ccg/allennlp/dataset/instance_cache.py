@@ -0,0 +1,179 @@
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CACHE_VERSION = 2
+# flat int32 arrays of the examples concatenated; those of the trees have one more element per example (root)
+TOKEN_ARRAYS = ['words', 'tags', 'labels', 'head_tags', 'head_indices', 'ancestors', 'path_patterns']
+TREE_ARRAYS = ['heads', 'depth', 'height']
+STRING_ARRAYS = ['words', 'tags', 'labels', 'head_tags', 'ancestors', 'path_patterns']
+# bits of the flags of an example, telling which of the optional arrays it has
+HAS_TARGETS, HAS_ANCESTORS, HAS_PATH_PATTERNS = 1, 2, 4
+# digests of the files read so far, keyed by (path, mtime, size)
+_FILE_DIGESTS: Dict[Tuple[str, int, int], str] = {}
+
+
+class TreeExample(NamedTuple):
+    """
+    an example of Tree2TreeDatasetReader, where the arrays of the UD tree include the root token.
+    heads: (n + 1,) head indices, where heads[0] = -1
+    depth, height: (n + 1,) depth and height of each node
+    ancestors, path_patterns: (n,) labels of get_least_common_ancestor and dependency_path_pattern
+    """
+    words: List[str]
+    heads: numpy.ndarray
+    depth: numpy.ndarray
+    height: numpy.ndarray
+    tags: List[str]
+    labels: List[str]
+    head_tags: Optional[List[str]] = None
+    head_indices: Optional[List[int]] = None
+    ancestors: Optional[List[str]] = None
+    path_patterns: Optional[List[str]] = None
+
+
+def file_digest(file_path: str) -> str:
+    """
+    :return:
+        the SHA-1 of the contents of file_path, computed once as long as its mtime and size do not change
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _FILE_DIGESTS:
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _FILE_DIGESTS[key] = digest.hexdigest()
+    return _FILE_DIGESTS[key]
+
+
+def indexer_config(token_indexers: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return:
+        the class and scalar attributes of each token indexer, as a part of the key of a cache
+    """
+    return {name: [f'{type(indexer).__module__}.{type(indexer).__qualname__}',
+                   {key: value for key, value in vars(indexer).items()
+                    if isinstance(value, (str, int, float, bool, type(None)))}]
+            for name, indexer in token_indexers.items()}
+
+
+def instance_cache_path(cache_directory: str, file_path: str, config: Dict[str, Any]) -> str:
+    """
+    :return:
+        the directory of the cache of file_path, keyed by the digest of its contents and config
+    """
+    key = hashlib.sha1(json.dumps([CACHE_VERSION, file_digest(file_path), config], sort_keys=True)
+                       .encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory, key)
+
+
+class InstanceCacheWriter:
+    """
+    writes TreeExample objects incrementally into a cache directory, as raw int32 arrays
+    (see TOKEN_ARRAYS and TREE_ARRAYS), where the strings are ids into a string table of the cache.
+    The files are written into a temporary directory, which is renamed at close(),
+    so that an interrupted pass leaves no cache behind.
+    """
+    def __init__(self, directory: str, source: str) -> None:
+        self.directory = directory
+        self.source = source
+        self._temporary_directory = f'{directory}.{os.getpid()}.tmp'
+        os.makedirs(self._temporary_directory, exist_ok=True)
+        self._files = {name: open(os.path.join(self._temporary_directory, f'{name}.bin'), 'wb')
+                       for name in TOKEN_ARRAYS + TREE_ARRAYS + ['lengths', 'flags']}
+        self._strings: Dict[str, int] = {}
+        self._num_examples = 0
+
+    def _ids(self, strings: List[str]) -> numpy.ndarray:
+        return numpy.array([self._strings.setdefault(string, len(self._strings)) for string in strings],
+                           dtype=numpy.int32)
+
+    def add(self, example: TreeExample) -> None:
+        length = len(example.words)
+        has_targets = example.head_tags is not None and example.head_indices is not None
+        flags = (HAS_TARGETS * has_targets
+                 | HAS_ANCESTORS * (example.ancestors is not None)
+                 | HAS_PATH_PATTERNS * (example.path_patterns is not None))
+        arrays = {
+            'words': self._ids(example.words),
+            'tags': self._ids(example.tags),
+            'labels': self._ids(example.labels),
+            'head_tags': self._ids(example.head_tags if has_targets else [''] * length),
+            'head_indices': numpy.array(example.head_indices if has_targets else [0] * length, dtype=numpy.int32),
+            'ancestors': self._ids(example.ancestors or [''] * length),
+            'path_patterns': self._ids(example.path_patterns or [''] * length),
+            'heads': example.heads,
+            'depth': example.depth,
+            'height': example.height,
+            'lengths': [length],
+            'flags': [flags],
+        }
+        for name, array in arrays.items():
+            numpy.asarray(array, dtype=numpy.int32).tofile(self._files[name])
+        self._num_examples += 1
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        strings = sorted(self._strings, key=self._strings.get)
+        with open(os.path.join(self._temporary_directory, 'strings.json'), 'w') as f:
+            json.dump(strings, f)
+        with open(os.path.join(self._temporary_directory, 'meta.json'), 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'source': self.source, 'num_examples': self._num_examples}, f)
+        try:
+            os.rename(self._temporary_directory, self.directory)
+            logger.info('cached %d examples of %s at %s', self._num_examples, self.source, self.directory)
+        except OSError:
+            # another process has written the same cache
+            shutil.rmtree(self._temporary_directory, ignore_errors=True)
+
+    def discard(self) -> None:
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self._temporary_directory, ignore_errors=True)
+
+
+def _memmap(file_path: str) -> numpy.ndarray:
+    # numpy.memmap cannot map an empty file
+    if os.path.getsize(file_path) == 0:
+        return numpy.empty(0, dtype=numpy.int32)
+    return numpy.memmap(file_path, dtype=numpy.int32, mode='r')
+
+
+def read_instance_cache(directory: str) -> Iterator[TreeExample]:
+    """
+    yields the TreeExample objects of a cache written by InstanceCacheWriter,
+    whose tree arrays are views of the memory-mapped files.
+    """
+    with open(os.path.join(directory, 'strings.json')) as f:
+        strings = json.load(f)
+    arrays = {name: _memmap(os.path.join(directory, f'{name}.bin'))
+              for name in TOKEN_ARRAYS + TREE_ARRAYS + ['lengths', 'flags']}
+    lengths = numpy.array(arrays['lengths'], dtype=numpy.int64)
+    token_offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+    tree_offsets = token_offsets + numpy.arange(len(token_offsets))
+    for i, flags in enumerate(arrays['flags'].tolist()):
+        has_targets = bool(flags & HAS_TARGETS)
+        start, end = token_offsets[i], token_offsets[i + 1]
+        tree_start, tree_end = tree_offsets[i], tree_offsets[i + 1]
+        values = {name: [strings[string_id] for string_id in arrays[name][start:end].tolist()]
+                  for name in STRING_ARRAYS}
+        yield TreeExample(words=values['words'],
+                          heads=arrays['heads'][tree_start:tree_end],
+                          depth=arrays['depth'][tree_start:tree_end],
+                          height=arrays['height'][tree_start:tree_end],
+                          tags=values['tags'],
+                          labels=values['labels'],
+                          head_tags=values['head_tags'] if has_targets else None,
+                          head_indices=arrays['head_indices'][start:end].tolist() if has_targets else None,
+                          ancestors=values['ancestors'] if flags & HAS_ANCESTORS else None,
+                          path_patterns=values['path_patterns'] if flags & HAS_PATH_PATTERNS else None)
@@ -0,0 +1,81 @@
+from typing import Any, Iterator, TextIO
+import json
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(json_file: TextIO, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    yields the elements of a top-level JSON array one by one, reading json_file
+    in chunks, so that the whole array is never in memory.
+    :param json_file: file object opened in text mode
+    :param chunk_size: number of characters read at once
+    """
+    buffer = ''
+    position = 0
+    at_eof = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, at_eof
+        chunk = json_file.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        at_eof = not chunk
+        return not at_eof
+
+    def skip_whitespace() -> None:
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position < len(buffer) or not read_more():
+                return
+
+    skip_whitespace()
+    if position >= len(buffer) or buffer[position] != '[':
+        raise ValueError('expected a JSON array at the top level')
+    position += 1
+    expect_element = True
+    while True:
+        skip_whitespace()
+        if position >= len(buffer):
+            raise ValueError('unexpected end of file in a JSON array')
+        if buffer[position] == ']':
+            return
+        if not expect_element:
+            if buffer[position] != ',':
+                raise ValueError(f'expected "," or "]" but got {buffer[position]!r}')
+            position += 1
+            skip_whitespace()
+        while True:
+            try:
+                element, end = _DECODER.raw_decode(buffer, position)
+                # a number may continue in the next chunk, so that the element is complete
+                # only when it is followed by a delimiter.
+                delimiter = end
+                while delimiter < len(buffer) and buffer[delimiter] in _WHITESPACE:
+                    delimiter += 1
+                if at_eof or (delimiter < len(buffer) and buffer[delimiter] in ',]'):
+                    break
+            except json.JSONDecodeError:
+                if at_eof:
+                    raise
+            read_more()
+        position = end
+        expect_element = False
+        yield element
+
+
+def iter_json_lines(json_file: TextIO, worker_index: int = 0, num_workers: int = 1) -> Iterator[Any]:
+    """
+    yields the objects of the non-empty lines of a JSON lines file,
+    only the worker_index-th of every num_workers of them, whose other lines are not parsed.
+    """
+    count = 0
+    for line in json_file:
+        if not line.strip():
+            continue
+        if count % num_workers == worker_index:
+            yield json.loads(line)
+        count += 1
@@ -1,8 +1,8 @@
-from typing import Dict, List, Any
+from typing import Dict, Iterator, List, Any
 import logging
-import numpy
+import os
 from overrides import overrides
-import json
+from allennlp.common.checks import ConfigurationError
 from allennlp.common.file_utils import cached_path
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.fields import SequenceLabelField, TextField, MetadataField, ArrayField
@@ -10,6 +10,11 @@ from allennlp.data.instance import Instance
 from allennlp.data.tokenizers import Token
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer
 from ud2ccg.allennlp.data.fields.int_array_field import IntArrayField
+from ud2ccg.allennlp.data.dependency_tree import build_tree_arrays, get_least_common_ancestor, \
+    dependency_path_pattern
+from ud2ccg.allennlp.dataset.instance_cache import InstanceCacheWriter, TreeExample, \
+    indexer_config, instance_cache_path, read_instance_cache
+from ud2ccg.allennlp.dataset.json_stream import iter_json_array, iter_json_lines
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -22,8 +27,36 @@ class Tree2TreeDatasetReader(DatasetReader):
                  ud_tag_token_indexers: Dict[str, TokenIndexer] = None,
                  ud_label_token_indexers: Dict[str, TokenIndexer] = None,
                  use_ancestor_field: bool = False,
-                 use_path_pattern_field: bool = False) -> None:
+                 use_path_pattern_field: bool = False,
+                 file_format: str = 'auto',
+                 worker_index: int = 0,
+                 num_workers: int = 1,
+                 cache_directory: str = None,
+                 pin_memory: bool = False) -> None:
+        """
+        :param file_format: "json" for a JSON array of the examples, "jsonl" for one example per line,
+            or "auto" for "jsonl" if the file name ends with ".jsonl" and "json" otherwise.
+            Both are read in a streaming way, so that with lazy=True the memory use is constant.
+        :param worker_index: read only the worker_index-th of every num_workers examples,
+            so that several loader processes can split one file
+        :param num_workers: number of loader processes
+        :param cache_directory: if given, the examples of each file are cached there after the first
+            complete pass, keyed by the contents of the file, the options above and the token indexers,
+            and read from the memory-mapped cache afterwards, without parsing JSON or building trees.
+            The cache holds the strings of the examples, not their vocabulary ids, which the indexers
+            still compute when the instances are indexed.
+        :param pin_memory: collate the head indices and tree features of a batch in pinned memory
+        """
         super().__init__(lazy)
+        if file_format not in ['auto', 'json', 'jsonl']:
+            raise ConfigurationError(f'unknown file format: {file_format}')
+        if not 0 <= worker_index < num_workers:
+            raise ConfigurationError(f'worker_index must be in [0, {num_workers}), but got {worker_index}')
+        self.file_format = file_format
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+        self.cache_directory = cache_directory
+        self.pin_memory = pin_memory
         self.use_ancestor_field = use_ancestor_field
         self.use_path_pattern_field = use_path_pattern_field
         self._token_indexers = token_indexers or {'tokens': SingleIdTokenIndexer()}
@@ -31,18 +64,85 @@ class Tree2TreeDatasetReader(DatasetReader):
         self._ud_label_token_indexers = ud_label_token_indexers or {'tokens': SingleIdTokenIndexer()}
 
     def _read(self, file_path):
-        with open(cached_path(file_path), 'r') as data_file:
+        file_path = cached_path(file_path)
+        if self.cache_directory is None:
+            for example in self._read_examples(file_path):
+                yield self._example_to_instance(example)
+            return
+
+        cache_path = instance_cache_path(self.cache_directory, file_path, self._cache_config())
+        if os.path.exists(cache_path):
+            logger.info('Reading instances of %s from cache at: %s', file_path, cache_path)
+            for example in read_instance_cache(cache_path):
+                yield self._example_to_instance(example)
+            return
+
+        writer = InstanceCacheWriter(cache_path, file_path)
+        try:
+            for example in self._read_examples(file_path):
+                writer.add(example)
+                yield self._example_to_instance(example)
+        except BaseException:
+            # including GeneratorExit, when the pass is not complete
+            writer.discard()
+            raise
+        writer.close()
+
+    def _cache_config(self) -> Dict[str, Any]:
+        return {
+            'file_format': self.file_format,
+            'worker_index': self.worker_index,
+            'num_workers': self.num_workers,
+            'use_ancestor_field': self.use_ancestor_field,
+            'use_path_pattern_field': self.use_path_pattern_field,
+            'token_indexers': indexer_config(self._token_indexers),
+            'ud_tag_token_indexers': indexer_config(self._ud_tag_token_indexers),
+            'ud_label_token_indexers': indexer_config(self._ud_label_token_indexers),
+        }
+
+    def _read_examples(self, file_path: str) -> Iterator[TreeExample]:
+        file_format = self.file_format
+        if file_format == 'auto':
+            file_format = 'jsonl' if file_path.endswith('.jsonl') else 'json'
+        with open(file_path, 'r') as data_file:
             logger.info('Reading instances from lines in file at: %s', file_path)
+            if file_format == 'jsonl':
+                examples = iter_json_lines(data_file, self.worker_index, self.num_workers)
+            else:
+                examples = (example for i, example in enumerate(iter_json_array(data_file))
+                            if i % self.num_workers == self.worker_index)
 
-            for (words, _), source, target in json.load(data_file):
+            for (words, _), source, target in examples:
                 (ud_head_indices, ud_tags, ud_labels) = source
                 (head_tags, head_indices) = target
-                yield self.text_to_instance(words=words,
-                                            ud_head_indices=ud_head_indices[1:],
-                                            ud_tags=ud_tags[1:],
-                                            ud_labels=ud_labels[1:],
-                                            head_tags=head_tags,
-                                            head_indices=head_indices)
+                yield self._make_example(words=words,
+                                         ud_head_indices=ud_head_indices[1:],
+                                         ud_tags=ud_tags[1:],
+                                         ud_labels=ud_labels[1:],
+                                         head_tags=head_tags,
+                                         head_indices=head_indices)
+
+    def _make_example(self,
+                      words: List[str],
+                      ud_head_indices: List[int],
+                      ud_tags: List[str],
+                      ud_labels: List[str],
+                      head_tags: List[str] = None,
+                      head_indices: List[int] = None) -> TreeExample:
+        # traversal schedule of the tree encoder, computed once here instead of every epoch
+        tree = build_tree_arrays([-1] + ud_head_indices)
+        ancestors = get_least_common_ancestor(ud_head_indices, tree) if self.use_ancestor_field else None
+        path_patterns = dependency_path_pattern(ud_head_indices, tree) if self.use_path_pattern_field else None
+        return TreeExample(words=words,
+                           heads=tree.heads.astype('i'),
+                           depth=tree.depth.astype('i'),
+                           height=tree.height.astype('i'),
+                           tags=ud_tags,
+                           labels=ud_labels,
+                           head_tags=head_tags,
+                           head_indices=head_indices,
+                           ancestors=ancestors,
+                           path_patterns=path_patterns)
 
     @overrides
     def text_to_instance(self,
@@ -54,8 +154,16 @@ class Tree2TreeDatasetReader(DatasetReader):
                          head_indices: List[int] = None,
                          metadata: Dict[str, Any] = None) -> Instance:
         # pylint: disable=arguments-differ
+        example = self._make_example(words, ud_head_indices, ud_tags, ud_labels, head_tags, head_indices)
+        return self._example_to_instance(example, metadata)
+
+    def _example_to_instance(self, example: TreeExample, metadata: Dict[str, Any] = None) -> Instance:
+        words, ud_tags, ud_labels = example.words, example.tags, example.labels
+        head_tags, head_indices = example.head_tags, example.head_indices
         token_field = TextField(list(map(Token, words)), self._token_indexers)
-        ud_head_index_field = IntArrayField(numpy.array([-1] + ud_head_indices, 'i'))
+        ud_head_index_field = IntArrayField(example.heads, pin_memory=self.pin_memory)
+        ud_depth_field = IntArrayField(example.depth, padding_value=-1, pin_memory=self.pin_memory)
+        ud_height_field = IntArrayField(example.height, padding_value=-1, pin_memory=self.pin_memory)
         ud_tag_field = TextField(list(map(Token, ud_tags)), self._ud_tag_token_indexers)
         ud_label_field = TextField(list(map(Token, ud_labels)), self._ud_label_token_indexers)
         metadata = metadata or {}
@@ -65,16 +173,18 @@ class Tree2TreeDatasetReader(DatasetReader):
             'words': token_field,
             'metadata': metadata,
             'ud_head_index_field': ud_head_index_field,
+            'ud_depth_field': ud_depth_field,
+            'ud_height_field': ud_height_field,
             'ud_tag_field': ud_tag_field,
             'ud_label_field': ud_label_field,
         }
         if self.use_ancestor_field:
             ancestor_field = SequenceLabelField(
-                get_least_common_ancestor(ud_head_indices), token_field, label_namespace='ancestors')
+                example.ancestors, token_field, label_namespace='ancestors')
             fields['ancestor_field'] = ancestor_field
         if self.use_path_pattern_field:
             path_pattern_field = SequenceLabelField(
-                dependency_path_pattern(ud_head_indices), token_field, label_namespace='path_pattern')
+                example.path_patterns, token_field, label_namespace='path_pattern')
             fields['path_pattern_field'] = path_pattern_field
 
         if head_tags is not None and head_indices is not None:
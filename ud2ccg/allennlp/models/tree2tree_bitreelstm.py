@@ -18,15 +18,17 @@ from allennlp.nn import InitializerApplicator, RegularizerApplicator, Activation
 from allennlp.nn.util import get_text_field_mask, get_range_vector
 from allennlp.nn.util import get_device_of, masked_log_softmax
 from allennlp.training.metrics import CategoricalAccuracy
-from my_allennlp.nn.bilinear import BilinearWithBias
-from my_allennlp.modules.seq2seq_encoders.treelstm_encoders import BidirectionalTreeLSTMEncoder
+from ud2ccg.allennlp.nn.bilinear import BilinearWithBias, LowRankBilinearWithBias
+from ud2ccg.allennlp.modules.seq2seq_encoders.treelstm_encoders import BidirectionalTreeLSTMEncoder
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
 def _apply_head_mask(attended_arcs: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     # Mask the diagonal, because the head of a word can't be itself.
-    attended_arcs = attended_arcs + torch.diag(attended_arcs.new(mask.size(1)).fill_(-numpy.inf))
+    # (compared positions rather than torch.diag, which cannot be exported to ONNX)
+    positions = get_range_vector(mask.size(1), get_device_of(mask))
+    attended_arcs = attended_arcs.masked_fill(positions.unsqueeze(0) == positions.unsqueeze(1), -numpy.inf)
     # Mask padded tokens, because we only want to consider actual words as heads.
     attended_arcs.masked_fill_((1 - mask).byte().unsqueeze(1), -numpy.inf)
     attended_arcs.masked_fill_((1 - mask).byte().unsqueeze(2), -numpy.inf)
@@ -51,7 +53,12 @@ class Tree2TreeBiTreeLSTM(Model):
                  initializer: InitializerApplicator = InitializerApplicator(),
                  regularizer: Optional[RegularizerApplicator] = None,
                  head_tag_temperature: Optional[float] = None,
-                 head_temperature: Optional[float] = None
+                 head_temperature: Optional[float] = None,
+                 parallel_tree_directions: bool = False,
+                 checkpoint_tree_levels: bool = False,
+                 legacy_tree_leaf_bias: bool = True,
+                 report_peak_memory: bool = False,
+                 tag_bilinear_rank: Optional[int] = None
                  ) -> None:
         super().__init__(vocab, regularizer)
 
@@ -62,7 +69,10 @@ class Tree2TreeBiTreeLSTM(Model):
         self.sequence_encoder = sequence_encoder
         embed_dim = sequence_encoder.get_output_dim() + ud_label_field_embedder.get_output_dim()
 
-        self.tree_encoder = BidirectionalTreeLSTMEncoder(embed_dim, tree_encoder_output_dim, dropout)
+        self.tree_encoder = BidirectionalTreeLSTMEncoder(embed_dim, tree_encoder_output_dim, dropout,
+                                                         parallel_directions=parallel_tree_directions,
+                                                         checkpoint_levels=checkpoint_tree_levels,
+                                                         legacy_leaf_bias=legacy_tree_leaf_bias)
 
         feedforward_input_dim = tree_encoder_output_dim
 
@@ -86,9 +96,15 @@ class Tree2TreeBiTreeLSTM(Model):
                                            dropout=dropout)
         self.child_tag_feedforward = copy.deepcopy(self.head_tag_feedforward)
 
-        self.tag_bilinear = BilinearWithBias(tag_representation_dim,
-                                             tag_representation_dim,
-                                             num_labels)
+        if tag_bilinear_rank is None:
+            self.tag_bilinear = BilinearWithBias(tag_representation_dim,
+                                                 tag_representation_dim,
+                                                 num_labels)
+        else:
+            self.tag_bilinear = LowRankBilinearWithBias(tag_representation_dim,
+                                                        tag_representation_dim,
+                                                        num_labels,
+                                                        tag_bilinear_rank)
         self._head_sentinel = torch.nn.Parameter(torch.randn([1, 1, embed_dim]))
 
         representation_dim = text_field_embedder.get_output_dim() + self.ud_tag_field_embedder.get_output_dim()
@@ -107,6 +123,8 @@ class Tree2TreeBiTreeLSTM(Model):
         self._tagging_accuracy = CategoricalAccuracy()
         self.head_tag_temperature = head_tag_temperature
         self.head_temperature = head_temperature
+        self._report_peak_memory = report_peak_memory
+        self._peak_memory_device = -1
         initializer(self)
 
     @overrides
@@ -116,11 +134,72 @@ class Tree2TreeBiTreeLSTM(Model):
                 ud_head_index_field: torch.LongTensor,
                 ud_tag_field: Dict[str, torch.LongTensor],
                 ud_label_field: Dict[str, torch.LongTensor],
-                # ancestor_field: torch.LongTensor,
-                # path_pattern_field: torch.LongTensor,
+                ud_depth_field: torch.LongTensor = None,
+                ud_height_field: torch.LongTensor = None,
+                ancestor_field: torch.LongTensor = None,
+                path_pattern_field: torch.LongTensor = None,
                 head_tags: torch.LongTensor = None,
                 head_indices: torch.LongTensor = None) -> Dict[str, torch.Tensor]:
-        # pylint: disable=arguments-differ
+        # pylint: disable=arguments-differ,unused-argument
+        # ancestor_field and path_pattern_field (use_ancestor_field and use_path_pattern_field
+        # of Tree2TreeDatasetReader) are accepted, but this model does not use them.
+        if self._report_peak_memory:
+            self._reset_peak_memory(get_device_of(ud_head_index_field))
+
+        if head_indices is not None and head_tags is not None:
+            encoded_text, mask = self._encode(words, ud_head_index_field, ud_tag_field, ud_label_field,
+                                              ud_depth_field, ud_height_field)
+            batch_size = mask.size(0)
+            head_indices = torch.cat([head_indices.new_zeros(batch_size, 1), head_indices], 1)
+            head_tags = torch.cat([head_tags.new_zeros(batch_size, 1), head_tags], 1)
+            attended_arcs, head_tag_representation, child_tag_representation = self._score(encoded_text)
+            loss, normalised_arc_logits, normalised_head_tag_logits = \
+                self._construct_loss(head_tag_representation=head_tag_representation,
+                                     child_tag_representation=child_tag_representation,
+                                     attended_arcs=attended_arcs,
+                                     head_indices=head_indices,
+                                     head_tags=head_tags,
+                                     mask=mask)
+
+            normalised_arc_logits = _apply_head_mask(normalised_arc_logits, mask)
+            tag_mask = self._get_unknown_tag_mask(mask, head_tags)
+            self._attachment_scores(normalised_arc_logits[:, 1:], head_indices[:, 1:], mask[:, 1:])
+            self._tagging_accuracy(normalised_head_tag_logits[:, 1:], head_tags[:, 1:], tag_mask[:, 1:])
+            output_dict = {
+                "heads": normalised_arc_logits,
+                "head_tags": normalised_head_tag_logits,
+                "loss": loss,
+                "mask": mask,
+            }
+        else:
+            # without gold labels there is no loss, and nothing to back-propagate
+            with torch.no_grad():
+                encoded_text, mask = self._encode(words, ud_head_index_field, ud_tag_field, ud_label_field,
+                                                  ud_depth_field, ud_height_field)
+                normalised_arc_logits, normalised_head_tag_logits = self._predict(encoded_text, mask)
+            output_dict = {
+                "heads": normalised_arc_logits,
+                "head_tags": normalised_head_tag_logits,
+                "mask": mask,
+            }
+
+        for key in metadata[0].keys():
+            output_dict[key] = [meta[key] for meta in metadata]
+        return output_dict
+
+    def _encode(self,
+                words: Dict[str, torch.LongTensor],
+                ud_head_index_field: torch.LongTensor,
+                ud_tag_field: Dict[str, torch.LongTensor],
+                ud_label_field: Dict[str, torch.LongTensor],
+                ud_depth_field: Optional[torch.LongTensor],
+                ud_height_field: Optional[torch.LongTensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return:
+            encoded_text: (batch_size, sequence_length + 1, tree encoder output dim)
+            mask: (batch_size, sequence_length + 1)
+            where "+ 1" is for the head sentinel.
+        """
         embedded_text_input = self.text_field_embedder(words)
         ud_tag_inputs = self.ud_tag_field_embedder(ud_tag_field)
         ud_label_inputs = self.ud_label_field_embedder(ud_label_field)
@@ -139,13 +218,18 @@ class Tree2TreeBiTreeLSTM(Model):
         # Concatenate the head sentinel onto the sentence representation.
         encoded_text = torch.cat([head_sentinel, encoded_text], 1)
         mask = torch.cat([mask.new_ones(batch_size, 1), mask], 1)
-        if head_indices is not None:
-            head_indices = torch.cat([head_indices.new_zeros(batch_size, 1), head_indices], 1)
-        if head_tags is not None:
-            head_tags = torch.cat([head_tags.new_zeros(batch_size, 1), head_tags], 1)
-
-        encoded_text = self.tree_encoder(encoded_text, ud_head_index_field, mask)
 
+        encoded_text = self.tree_encoder(encoded_text, ud_head_index_field, mask,
+                                         ud_depth_field, ud_height_field)
+        return encoded_text, mask
+
+    def _score(self, encoded_text: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        :return:
+            attended_arcs: (batch_size, sequence_length, sequence_length)
+            head_tag_representation, child_tag_representation:
+                (batch_size, sequence_length, tag_representation_dim)
+        """
         # shape (batch_size, sequence_length, arc_representation_dim)
         head_arc_representation = self.head_arc_feedforward(encoded_text)
         child_arc_representation = self.child_arc_feedforward(encoded_text)
@@ -156,54 +240,41 @@ class Tree2TreeBiTreeLSTM(Model):
         # shape (batch_size, sequence_length, sequence_length)
         attended_arcs = self.arc_attention(head_arc_representation,
                                            child_arc_representation)
-
-        if head_indices is not None and head_tags is not None:
-            loss, normalised_arc_logits, normalised_head_tag_logits = \
-                self._construct_loss(head_tag_representation=head_tag_representation,
-                                     child_tag_representation=child_tag_representation,
-                                     attended_arcs=attended_arcs,
-                                     head_indices=head_indices,
-                                     head_tags=head_tags,
-                                     mask=mask)
-
-            normalised_arc_logits = _apply_head_mask(normalised_arc_logits, mask)
-            tag_mask = self._get_unknown_tag_mask(mask, head_tags)
-            self._attachment_scores(normalised_arc_logits[:, 1:], head_indices[:, 1:], mask[:, 1:])
-            self._tagging_accuracy(normalised_head_tag_logits[:, 1:], head_tags[:, 1:], tag_mask[:, 1:])
-
-        else:
-            attended_arcs = _apply_head_mask(attended_arcs, mask)
-            # Compute the heads greedily.
-            # shape (batch_size, sequence_length)
-            _, predicted_heads = attended_arcs.max(dim=2)
-
-            # Given the greedily predicted heads, decode their dependency tags.
-            # shape (batch_size, sequence_length, num_head_tags)
-            head_tag_logits = self._get_head_tags(head_tag_representation,
-                                                  child_tag_representation,
-                                                  predicted_heads)
-            _, predicted_head_tags = head_tag_logits.max(dim=2)
-
-            loss, normalised_arc_logits, normalised_head_tag_logits = \
-                self._construct_loss(head_tag_representation=head_tag_representation,
-                                     child_tag_representation=child_tag_representation,
-                                     attended_arcs=attended_arcs,
-                                     head_indices=predicted_heads.long(),
-                                     head_tags=predicted_head_tags.long(),
-                                     mask=mask,
-                                     head_tag_temperature=self.head_tag_temperature,
-                                     head_temperature=self.head_temperature)
-            normalised_arc_logits = _apply_head_mask(normalised_arc_logits, mask)
-
-        output_dict = {
-            "heads": normalised_arc_logits,
-            "head_tags": normalised_head_tag_logits,
-            "loss": loss,
-            "mask": mask,
-        }
-        for key in metadata[0].keys():
-            output_dict[key] = [meta[key] for meta in metadata]
-        return output_dict
+        return attended_arcs, head_tag_representation, child_tag_representation
+
+    def _predict(self, encoded_text: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        normalised arc and tag scores given greedily predicted heads, the same as _construct_loss
+        returns on the predictions, but with each score computed once.
+        :return:
+            normalised_arc_logits: (batch_size, sequence_length, sequence_length),
+                -inf for the diagonal and padding
+            normalised_head_tag_logits: (batch_size, sequence_length, num_head_tags),
+                zero for padding and for tokens whose predicted tag is unknown
+        """
+        attended_arcs, head_tag_representation, child_tag_representation = self._score(encoded_text)
+        attended_arcs = _apply_head_mask(attended_arcs, mask)
+        # Compute the heads greedily.
+        # shape (batch_size, sequence_length)
+        _, predicted_heads = attended_arcs.max(dim=2)
+        if self.head_temperature:
+            attended_arcs /= self.head_temperature
+        normalised_arc_logits = masked_log_softmax(attended_arcs, mask)
+        # rows of padding tokens are all -inf, and are NaN after the softmax
+        normalised_arc_logits.masked_fill_((1 - mask).byte().unsqueeze(2), -numpy.inf)
+
+        # Given the greedily predicted heads, decode their dependency tags.
+        # shape (batch_size, sequence_length, num_head_tags)
+        head_tag_logits = self._get_head_tags(head_tag_representation,
+                                              child_tag_representation,
+                                              predicted_heads)
+        _, predicted_head_tags = head_tag_logits.max(dim=2)
+        tag_mask = self._get_unknown_tag_mask(mask, predicted_head_tags)
+        if self.head_tag_temperature:
+            head_tag_logits /= self.head_tag_temperature
+        normalised_head_tag_logits = masked_log_softmax(head_tag_logits,
+                                                        tag_mask.unsqueeze(-1)) * tag_mask.float().unsqueeze(-1)
+        return normalised_arc_logits, normalised_head_tag_logits
 
     @overrides
     def decode(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
@@ -294,6 +365,21 @@ class Tree2TreeBiTreeLSTM(Model):
         new_mask = new_mask * (1 - oov_mask)
         return new_mask
 
+    def _reset_peak_memory(self, device: int) -> None:
+        """
+        starts measuring the peak CUDA memory allocated during the current batch,
+        which the trainer reads as "peak_memory_mb" in the metrics after its backward pass.
+        On CPU, nothing is measured, as only the peak resident set size of the whole process
+        is available, which never goes down.
+        """
+        self._peak_memory_device = device
+        if device < 0:
+            return
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+
     @overrides
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         dependency = self._attachment_scores.get_metric(reset)
@@ -304,5 +390,8 @@ class Tree2TreeBiTreeLSTM(Model):
             'tagging': tagging,
             'harmonic_mean': harmonic_mean,
         }
+        if self._report_peak_memory and self._peak_memory_device >= 0:
+            # over the forward and backward passes of the last batch
+            scores['peak_memory_mb'] = torch.cuda.max_memory_allocated(self._peak_memory_device) / 1024 ** 2
         return scores
 
@@ -0,0 +1,252 @@
+from typing import Any, Dict, Iterator, List, Tuple
+import argparse
+import json
+import logging
+
+import torch
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.data import DatasetReader, Instance, Vocabulary
+from allennlp.data.dataset import Batch
+from allennlp.models.archival import load_archive
+from allennlp.models.model import Model
+from allennlp.modules.seq2seq_encoders.pytorch_seq2seq_wrapper import PytorchSeq2SeqWrapper
+# pylint: disable=unused-import
+# registers the model, the dataset reader and the afix indexer / embedder
+import ud2ccg.allennlp.models.tree2tree_bitreelstm
+import ud2ccg.allennlp.dataset.tree2tree_dataset
+import ud2ccg.allennlp.data.afix_indexer
+import ud2ccg.allennlp.nn.afix_embedding
+# pylint: enable=unused-import
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# fields that are not inputs of the exported module
+NON_INPUT_FIELDS = ['metadata', 'head_tags', 'head_indices']
+
+
+class PaddedRnnEncoder(torch.nn.Module):
+    """
+    runs the RNN of a PytorchSeq2SeqWrapper on the padded batch, so that it can be traced
+    for any batch size and sentence lengths (the wrapper sorts and packs the batch
+    with lists of lengths, which a trace records as constants).
+    each direction of each layer is run by a one-layer RNN with the weights of that direction,
+    where the backward one reads every sentence reversed within its length, so that
+    the outputs are those of the wrapper (zero for padding).
+    :param encoder: PytorchSeq2SeqWrapper object, whose module is a batch first LSTM, GRU or RNN
+    """
+    def __init__(self, encoder: PytorchSeq2SeqWrapper) -> None:
+        super().__init__()
+        rnn = encoder._module  # pylint: disable=protected-access
+        if not isinstance(rnn, torch.nn.RNNBase) or not rnn.batch_first:
+            raise ConfigurationError(f'cannot export a sequence encoder of {type(rnn).__name__}')
+        options = {'nonlinearity': rnn.nonlinearity} if isinstance(rnn, torch.nn.RNN) else {}
+        self.num_directions = 2 if rnn.bidirectional else 1
+        self.layers = torch.nn.ModuleList()
+        for layer in range(rnn.num_layers):
+            input_size = rnn.input_size if layer == 0 else rnn.hidden_size * self.num_directions
+            for suffix in ['', '_reverse'][:self.num_directions]:
+                direction = type(rnn)(input_size, rnn.hidden_size, bias=rnn.bias, batch_first=True, **options)
+                direction.load_state_dict({name: getattr(rnn, f'{name[:-len("l0")]}l{layer}{suffix}')
+                                           for name, _ in direction.named_parameters()})
+                self.layers.append(direction)
+
+    def forward(self, inputs: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:  # type: ignore
+        # pylint: disable=arguments-differ
+        mask = mask.long()
+        lengths = mask.sum(1, keepdim=True)
+        positions = torch.arange(inputs.size(1), device=inputs.device).unsqueeze(0)
+        # the position read at each step by the backward direction (padding stays in place)
+        reverse = torch.where(positions < lengths, lengths - 1 - positions, positions).unsqueeze(2)
+        outputs = inputs
+        for layer in range(0, len(self.layers), self.num_directions):
+            forward_outputs, _ = self.layers[layer](outputs)
+            if self.num_directions == 1:
+                outputs = forward_outputs
+                continue
+            backward_outputs, _ = self.layers[layer + 1](outputs.gather(1, reverse.expand_as(outputs)))
+            backward_outputs = backward_outputs.gather(1, reverse.expand_as(backward_outputs))
+            outputs = torch.cat([forward_outputs, backward_outputs], dim=2)
+        return outputs * mask.unsqueeze(2).to(outputs.dtype)
+
+
+class Tree2TreeInference(torch.nn.Module):
+    """
+    wraps Tree2TreeBiTreeLSTM so that it takes a flat list of tensors and returns
+    the log probabilities of heads and head_tags, as Tree2TreeBiTreeLSTM.decode does
+    (without the root token, padding and unknown categories).
+    :param model: Tree2TreeBiTreeLSTM object
+    :param input_names: names of the input tensors, e.g. "words.tokens" for words["tokens"]
+    """
+    def __init__(self, model: Model, input_names: List[str]) -> None:
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:  # type: ignore
+        # pylint: disable=arguments-differ
+        fields: Dict[str, Any] = {}
+        for name, tensor in zip(self.input_names, inputs):
+            field_name, _, key = name.partition('.')
+            if key:
+                fields.setdefault(field_name, {})[key] = tensor
+            else:
+                fields[field_name] = tensor
+        output_dict = self.model(metadata=[{}], **fields)
+        return output_dict['heads'][:, 1:], output_dict['head_tags'][:, 1:, 2:]
+
+
+def make_traceable(model: Model) -> None:
+    """
+    replaces the parts of a Tree2TreeBiTreeLSTM in evaluation mode whose traces only hold
+    for the shape of the traced inputs with equivalent ones.
+    """
+    assert not model.training
+    if isinstance(model.sequence_encoder, PytorchSeq2SeqWrapper):
+        model.sequence_encoder = PaddedRnnEncoder(model.sequence_encoder)
+    # InputVariationalDropout makes its (all ones in evaluation) mask from tensor.data,
+    # which a trace records as a constant
+    model._input_dropout = torch.nn.Identity()  # pylint: disable=protected-access
+
+
+def max_difference(expected: torch.Tensor, actual: torch.Tensor) -> float:
+    """
+    :return:
+        the largest absolute difference of the finite values, inf if the shapes
+        or the positions of the infinite values differ
+    """
+    finite = torch.isfinite(expected)
+    if expected.size() != actual.size() or not torch.equal(finite, torch.isfinite(actual)):
+        return float('inf')
+    return float((expected[finite] - actual[finite]).abs().max()) if finite.any() else 0.0
+
+
+def read_json_instances(reader: DatasetReader, file_path: str) -> Iterator[Instance]:
+    """
+    reads a JSON lines file in the input format of Tree2treePredictor
+    (with "words", "heads", "tags" and "head_labels").
+    """
+    with open(file_path) as json_file:
+        for line in json_file:
+            if not line.strip():
+                continue
+            json_dict = json.loads(line)
+            yield reader.text_to_instance(words=json_dict['words'],
+                                          ud_head_indices=json_dict['heads'],
+                                          ud_tags=json_dict['tags'],
+                                          ud_labels=json_dict['head_labels'],
+                                          metadata=json_dict.get('metadata', None))
+
+
+def batch_to_inputs(instances: List[Instance],
+                    vocab: Vocabulary,
+                    cuda_device: int = -1) -> Tuple[List[str], List[torch.Tensor]]:
+    """
+    indexes and pads a batch of instances and flattens it into named input tensors.
+    :return:
+        input names and tensors
+    """
+    batch = Batch(instances)
+    batch.index_instances(vocab)
+    tensor_dict = batch.as_tensor_dict(batch.get_padding_lengths())
+    names, tensors = [], []
+    for field_name, value in sorted(tensor_dict.items()):
+        if field_name in NON_INPUT_FIELDS:
+            continue
+        if isinstance(value, dict):
+            for key, tensor in sorted(value.items()):
+                names.append(f'{field_name}.{key}')
+                tensors.append(tensor)
+        else:
+            names.append(field_name)
+            tensors.append(value)
+    if cuda_device >= 0:
+        tensors = [tensor.cuda(cuda_device) for tensor in tensors]
+    return names, tensors
+
+
+def load_model_and_reader(archive_file: str, cuda_device: int = -1) -> Tuple[Model, DatasetReader]:
+    """
+    :return:
+        the archived model in evaluation mode and its dataset reader
+    """
+    archive = load_archive(archive_file, cuda_device=cuda_device)
+    model = archive.model
+    model.eval()
+    reader = DatasetReader.from_params(archive.config.duplicate()['dataset_reader'])
+    return model, reader
+
+
+def read_first_batch(reader: DatasetReader, file_path: str, batch_size: int) -> List[Instance]:
+    instances = []
+    for instance in read_json_instances(reader, file_path):
+        instances.append(instance)
+        if len(instances) == batch_size:
+            break
+    return instances
+
+
+def read_trace_batches(reader: DatasetReader,
+                       file_path: str,
+                       batch_size: int) -> Tuple[List[Instance], List[Instance]]:
+    """
+    :return:
+        the first batch_size instances of file_path, on which a model is exported,
+        and a batch of the next batch_size - 1 (or fewer) instances, which differs in shape
+        and is used to check the exported model (empty if there are no more instances)
+    """
+    instances = read_first_batch(reader, file_path, 2 * batch_size - 1)
+    return instances[:batch_size], instances[batch_size:]
+
+
+def export_torchscript(archive_file: str,
+                       input_file: str,
+                       output_file: str,
+                       batch_size: int = 8,
+                       cuda_device: int = -1,
+                       tolerance: float = 1e-4) -> None:
+    """
+    exports a trained Tree2TreeBiTreeLSTM as a single TorchScript module.
+    the tree encoder is compiled with torch.jit.script, so that the loops over tree levels
+    stay in the graph, and the rest of the model is traced on the first batch of input_file.
+    The outputs of the exported module are checked against those of the eager model
+    on that batch and on the next one, which has another shape.
+    The input names are stored in the extra file "input_names.json".
+    """
+    model, reader = load_model_and_reader(archive_file, cuda_device)
+    instances, check_instances = read_trace_batches(reader, input_file, batch_size)
+    names, tensors = batch_to_inputs(instances, model.vocab, cuda_device)
+    check_inputs = [tuple(tensors)]
+    if check_instances:
+        check_names, check_tensors = batch_to_inputs(check_instances, model.vocab, cuda_device)
+        assert check_names == names
+        check_inputs.append(tuple(check_tensors))
+
+    inference = Tree2TreeInference(model, names)
+    with torch.no_grad():
+        expected_outputs = [inference(*inputs) for inputs in check_inputs]
+        make_traceable(model)
+        model.tree_encoder = torch.jit.script(model.tree_encoder)
+        module = torch.jit.trace(inference, tuple(tensors), check_inputs=check_inputs)
+        differences = [max_difference(expected, actual)
+                       for inputs, expected_output in zip(check_inputs, expected_outputs)
+                       for expected, actual in zip(expected_output, module(*inputs))]
+    logger.info('max absolute difference from the eager model on %d batches: %g',
+                len(check_inputs), max(differences))
+    if max(differences) > tolerance:
+        raise ValueError(f'the exported module differs from the eager model by {max(differences)}')
+    torch.jit.save(module, output_file, _extra_files={'input_names.json': json.dumps(names)})
+    logger.info('exported TorchScript module with inputs %s to %s', names, output_file)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser('export Tree2TreeBiTreeLSTM as a TorchScript module')
+    parser.add_argument('ARCHIVE', help='model.tar.gz')
+    parser.add_argument('INPUT', help='JSON lines file used for tracing (e.g. geometry/geo-train.json)')
+    parser.add_argument('OUTPUT')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--cuda-device', type=int, default=-1)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+    export_torchscript(args.ARCHIVE, args.INPUT, args.OUTPUT, args.batch_size, args.cuda_device, args.tolerance)
@@ -0,0 +1,72 @@
+import argparse
+import json
+import logging
+import os
+import tarfile
+import tempfile
+
+import torch
+
+from allennlp.models.archival import CONFIG_NAME, _WEIGHTS_NAME
+from ud2ccg.allennlp.nn.bilinear import factorize_bilinear_state_dict
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+TAG_BILINEAR_PREFIX = 'tag_bilinear.'
+
+
+def relative_error(weight: torch.Tensor, U: torch.Tensor, V: torch.Tensor) -> float:
+    """
+    ||weight - U^T V|| / ||weight|| in the Frobenius norm, over all the output features
+    """
+    approximation = torch.matmul(U.transpose(1, 2), V)
+    return ((weight - approximation).norm() / weight.norm()).item()
+
+
+def convert_archive(archive_file: str, output_file: str, rank: int) -> None:
+    """
+    replaces the full-rank tag_bilinear of an archived Tree2TreeBiTreeLSTM with
+    a LowRankBilinearWithBias approximating it, and writes the result as a new archive
+    (with "tag_bilinear_rank" set in the model config).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        with tarfile.open(archive_file, 'r:gz') as archive:
+            archive.extractall(directory)
+
+        config_file = os.path.join(directory, CONFIG_NAME)
+        with open(config_file) as f:
+            config = json.load(f)
+        current_rank = config['model'].get('tag_bilinear_rank')
+        if current_rank is not None:
+            raise ValueError(f'tag_bilinear of {archive_file} is already of rank {current_rank}')
+        config['model']['tag_bilinear_rank'] = rank
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=4)
+
+        weights_file = os.path.join(directory, _WEIGHTS_NAME)
+        state_dict = torch.load(weights_file, map_location='cpu')
+        weight = state_dict[TAG_BILINEAR_PREFIX + 'W']
+        state_dict = factorize_bilinear_state_dict(state_dict, rank, prefix=TAG_BILINEAR_PREFIX)
+        torch.save(state_dict, weights_file)
+        logger.info('factorized tag_bilinear of shape %s into rank %d: %d -> %d parameters, relative error %.4f',
+                    tuple(weight.shape), rank, weight.numel(),
+                    state_dict[TAG_BILINEAR_PREFIX + 'U'].numel() + state_dict[TAG_BILINEAR_PREFIX + 'V'].numel(),
+                    relative_error(weight,
+                                   state_dict[TAG_BILINEAR_PREFIX + 'U'],
+                                   state_dict[TAG_BILINEAR_PREFIX + 'V']))
+
+        with tarfile.open(output_file, 'w:gz') as archive:
+            for name in sorted(os.listdir(directory)):
+                archive.add(os.path.join(directory, name), arcname=name)
+    logger.info('wrote %s', output_file)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        'approximate the tag_bilinear of a trained Tree2TreeBiTreeLSTM with a low-rank one')
+    parser.add_argument('ARCHIVE', help='model.tar.gz')
+    parser.add_argument('OUTPUT', help='model.tar.gz with the low-rank tag_bilinear')
+    parser.add_argument('--rank', type=int, required=True)
+    args = parser.parse_args()
+    convert_archive(args.ARCHIVE, args.OUTPUT, args.rank)
@@ -0,0 +1,367 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import copy
+import inspect
+import itertools
+import json
+import logging
+
+import numpy
+import torch
+
+from allennlp.data import Instance, Vocabulary
+from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN
+from allennlp.models.model import Model
+from allennlp.modules.matrix_attention.bilinear_matrix_attention import BilinearMatrixAttention
+from ud2ccg.allennlp.models.tree2tree_export import Tree2TreeInference, batch_to_inputs, \
+    load_model_and_reader, make_traceable, read_json_instances, read_trace_batches
+from ud2ccg.allennlp.modules.seq2seq_encoders.treelstm_encoders import BidirectionalTreeLSTMEncoder
+from ud2ccg.allennlp.nn.bilinear import BilinearWithBias
+from ud2ccg.allennlp.nn.treelstm import BidirectionalTreeLSTM, DenseTreeSchedule, \
+    make_dense_schedule, make_padded_schedule
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SCHEDULE_INPUTS = list(DenseTreeSchedule._fields)
+OUTPUTS = ['heads', 'head_tags']
+
+
+class _DenseTreeLSTM(torch.nn.Module):
+    """
+    BidirectionalTreeLSTM.forward_dense as forward, so that it can be scripted on its own
+    """
+    def __init__(self, encoder: BidirectionalTreeLSTM) -> None:
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self,  # type: ignore
+                inputs: torch.Tensor,
+                topdown_nodes: torch.Tensor,
+                topdown_parents: torch.Tensor,
+                bottomup_nodes: torch.Tensor,
+                bottomup_children: torch.Tensor,
+                leaf_bias: torch.Tensor) -> torch.Tensor:
+        # pylint: disable=arguments-differ
+        _, hs = self.encoder.forward_dense(inputs, topdown_nodes, topdown_parents,
+                                           bottomup_nodes, bottomup_children, leaf_bias)
+        return hs
+
+
+class _ScheduledTreeEncoder(torch.nn.Module):
+    """
+    stands in for BidirectionalTreeLSTMEncoder in the exported model,
+    and runs on the dense schedule given to Tree2TreeOnnxInference
+    """
+    def __init__(self, encoder: BidirectionalTreeLSTMEncoder) -> None:
+        super().__init__()
+        self.dense_encoder = torch.jit.script(_DenseTreeLSTM(encoder.encoder))
+        self.schedule: Optional[DenseTreeSchedule] = None
+
+    def forward(self,  # type: ignore
+                inputs: torch.Tensor,
+                head_indices: torch.Tensor,
+                mask: torch.Tensor,
+                depths: torch.Tensor = None,
+                heights: torch.Tensor = None) -> torch.Tensor:
+        # pylint: disable=arguments-differ,unused-argument
+        assert self.schedule is not None
+        batch_size, sequence_length, _ = inputs.size()
+        # the rank of the outputs of the scripted level loops is unknown to the exporter
+        return self.dense_encoder(inputs, *self.schedule).reshape(batch_size, sequence_length, -1)
+
+
+class _ArcAttention(torch.nn.Module):
+    """
+    BilinearMatrixAttention with a single label, without the squeeze of the label dimension,
+    which is exported from a trace as a conditional whose output rank is unknown
+    """
+    def __init__(self, attention: BilinearMatrixAttention) -> None:
+        super().__init__()
+        self.attention = attention
+
+    def forward(self, matrix_1: torch.Tensor, matrix_2: torch.Tensor) -> torch.Tensor:  # type: ignore
+        # pylint: disable=arguments-differ,protected-access
+        attention = self.attention
+        if attention._use_input_biases:
+            matrix_1 = torch.cat([matrix_1, torch.ones_like(matrix_1[:, :, :1])], -1)
+            matrix_2 = torch.cat([matrix_2, torch.ones_like(matrix_2[:, :, :1])], -1)
+        final = torch.matmul(torch.matmul(matrix_1, attention._weight_matrix), matrix_2.transpose(1, 2))
+        return attention._activation(final + attention._bias)
+
+
+class _Bilinear(torch.nn.Module):
+    """
+    BilinearWithBias by matrix products, as torch.nn.functional.bilinear has no ONNX operator
+    """
+    def __init__(self, bilinear: BilinearWithBias) -> None:
+        super().__init__()
+        self.bilinear = bilinear
+
+    def forward(self, input1: torch.Tensor, input2: torch.Tensor) -> torch.Tensor:  # type: ignore
+        # pylint: disable=arguments-differ
+        bilinear = self.bilinear
+        # (in1_features, out_features * in2_features)
+        weight = bilinear.W.transpose(0, 1).reshape(bilinear.in1_features, -1)
+        projected = torch.matmul(input1, weight).view(
+            *input1.shape[:-1], bilinear.out_features, bilinear.in2_features)
+        result = (projected * input2.unsqueeze(-2)).sum(-1) + bilinear.bias
+        result += torch.nn.functional.linear(input1, bilinear.V1, None)
+        result += torch.nn.functional.linear(input2, bilinear.V2, None)
+        return result
+
+
+def make_exportable(model: Model) -> None:
+    """
+    tree2tree_export.make_traceable, which also replaces the layers of a Tree2TreeBiTreeLSTM
+    that cannot be exported to ONNX from a trace with equivalent ones.
+    """
+    make_traceable(model)
+    if isinstance(model.arc_attention, BilinearMatrixAttention) \
+            and model.arc_attention._weight_matrix.dim() == 2:  # pylint: disable=protected-access
+        model.arc_attention = _ArcAttention(model.arc_attention)
+    if isinstance(model.tag_bilinear, BilinearWithBias):
+        model.tag_bilinear = _Bilinear(model.tag_bilinear)
+
+
+class Tree2TreeOnnxInference(Tree2TreeInference):
+    """
+    Tree2TreeInference whose last inputs are the tensors of a DenseTreeSchedule
+    (in the order of SCHEDULE_INPUTS), so that the tree traversal is exported as
+    a loop over the levels given as graph inputs.
+    :param model: Tree2TreeBiTreeLSTM object, whose tree encoder is replaced
+    :param input_names: names of the input tensors except the schedule
+    """
+    def __init__(self, model: Model, input_names: List[str]) -> None:
+        super().__init__(model, input_names)
+        model.tree_encoder = _ScheduledTreeEncoder(model.tree_encoder)
+
+    def forward(self, *inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:  # type: ignore
+        num_inputs = len(self.input_names)
+        self.model.tree_encoder.schedule = DenseTreeSchedule(*inputs[num_inputs:])
+        return super().forward(*inputs[:num_inputs])
+
+
+def dense_schedule_inputs(names: List[str],
+                          tensors: List[torch.Tensor],
+                          legacy_leaf_bias: bool) -> DenseTreeSchedule:
+    """
+    builds the dense tree schedule from the head, depth and height fields of a batch
+    :param legacy_leaf_bias: BidirectionalTreeLSTM.legacy_leaf_bias of the model
+    """
+    fields = dict(zip(names, tensors))
+    schedule = make_padded_schedule(fields['ud_head_index_field'],
+                                    fields['ud_depth_field'],
+                                    fields['ud_height_field'],
+                                    legacy_leaf_bias)
+    return make_dense_schedule(schedule)
+
+
+def export_onnx(archive_file: str,
+                input_file: str,
+                output_file: str,
+                batch_size: int = 8,
+                opset_version: int = 11) -> None:
+    """
+    exports a trained Tree2TreeBiTreeLSTM as an ONNX graph, whose inputs are the model inputs
+    (named as in tree2tree_export.batch_to_inputs) followed by SCHEDULE_INPUTS,
+    and whose outputs are the log probabilities of heads and head_tags.
+    The model is traced on the first batch of input_file, and the trace is checked
+    on that batch and on the next one, which has another shape.
+    """
+    model, reader = load_model_and_reader(archive_file)
+    legacy_leaf_bias = model.tree_encoder.encoder.legacy_leaf_bias
+    instances, check_instances = read_trace_batches(reader, input_file, batch_size)
+    names, tensors = batch_to_inputs(instances, model.vocab)
+    inputs = tuple(tensors) + tuple(dense_schedule_inputs(names, tensors, legacy_leaf_bias))
+    check_inputs = [inputs]
+    if check_instances:
+        check_names, check_tensors = batch_to_inputs(check_instances, model.vocab)
+        assert check_names == names
+        check_inputs.append(tuple(check_tensors) + tuple(dense_schedule_inputs(names, check_tensors,
+                                                                               legacy_leaf_bias)))
+    model = copy.deepcopy(model)
+    make_exportable(model)
+    module = Tree2TreeOnnxInference(model, names)
+
+    input_names = names + SCHEDULE_INPUTS
+    dynamic_axes = {name: list(range(tensor.dim())) for name, tensor in zip(input_names, inputs)}
+    dynamic_axes.update({name: [0, 1, 2] for name in OUTPUTS})
+    # newer versions of torch export with torch.export by default, which cannot keep the level loops
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        # the scripted tree encoder can only be exported as part of a TorchScript module
+        module = torch.jit.trace(module, inputs, check_inputs=check_inputs)
+        if 'example_outputs' in inspect.signature(torch.onnx.export).parameters:
+            options['example_outputs'] = module(*inputs)
+        torch.onnx.export(module, inputs, output_file,
+                          input_names=input_names,
+                          output_names=OUTPUTS,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          **options)
+    logger.info('exported ONNX graph with inputs %s to %s', input_names, output_file)
+
+
+class OnnxTree2TreeRunner:
+    """
+    runs an exported Tree2TreeBiTreeLSTM with onnxruntime on Tree2TreeDatasetReader instances.
+    :param onnx_file: graph exported by export_onnx
+    :param vocab: vocabulary of the archived model
+    :param num_threads: number of intra-op threads of onnxruntime (0 for its default)
+    """
+    def __init__(self, onnx_file: str, vocab: Vocabulary, num_threads: int = 0) -> None:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_file, options)
+        # inputs that the model does not use are pruned from the graph
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        # leaf_bias is only used by models with legacy_leaf_bias
+        self.legacy_leaf_bias = 'leaf_bias' in self.input_names
+        self.vocab = vocab
+
+    def run(self, instances: List[Instance]) -> List[Dict[str, numpy.ndarray]]:
+        """
+        :return:
+            for each instance, "heads": (sentence length, sentence length + 1) and
+            "head_tags": (sentence length, number of categories) log probabilities
+        """
+        names, tensors = batch_to_inputs(instances, self.vocab)
+        inputs = dict(zip(names, tensors))
+        inputs.update(zip(SCHEDULE_INPUTS, dense_schedule_inputs(names, tensors, self.legacy_leaf_bias)))
+        heads, head_tags = self.session.run(OUTPUTS, {name: inputs[name].numpy() for name in self.input_names})
+        results = []
+        for instance, instance_heads, instance_head_tags in zip(instances, heads, head_tags):
+            length = len(instance.fields['words'].tokens)
+            results.append({
+                'words': [token.text for token in instance.fields['words'].tokens],
+                'heads': instance_heads[:length, :length + 1],
+                'head_tags': instance_head_tags[:length],
+            })
+        return results
+
+
+def _max_difference(expected: numpy.ndarray, actual: numpy.ndarray) -> float:
+    finite = numpy.isfinite(expected)
+    if expected.shape != actual.shape or not numpy.array_equal(finite, numpy.isfinite(actual)):
+        return numpy.inf
+    return float(numpy.abs(expected[finite] - actual[finite]).max(initial=0.0))
+
+
+def _varying_batches(instances: List[Instance], batch_size: int) -> Iterator[List[Instance]]:
+    """
+    splits instances into batches of batch_size, batch_size - 1, ..., 1, batch_size, ... instances
+    """
+    start = 0
+    for size in itertools.cycle(range(batch_size, 0, -1)):
+        if start >= len(instances):
+            return
+        yield instances[start:start + size]
+        start += size
+
+
+def check_parity(archive_file: str,
+                 onnx_file: str,
+                 input_file: str,
+                 batch_size: int = 8,
+                 tolerance: float = 1e-4) -> bool:
+    """
+    compares the log probabilities of heads and head_tags from the ONNX graph
+    with those of the eager model on every sentence of input_file
+    (e.g. geometry/geo-train.json), in batches of 1 to batch_size sentences,
+    so that the graph is run on other shapes than the one it was exported with.
+    :return:
+        whether all the differences are within tolerance
+    """
+    model, reader = load_model_and_reader(archive_file)
+    runner = OnnxTree2TreeRunner(onnx_file, model.vocab)
+    instances = list(read_json_instances(reader, input_file))
+    max_differences = {name: 0.0 for name in OUTPUTS}
+    shapes = set()
+    for batch in _varying_batches(instances, batch_size):
+        shapes.add((len(batch), max(len(instance.fields['words'].tokens) for instance in batch)))
+        expected_outputs = model.forward_on_instances(batch)
+        for expected, actual in zip(expected_outputs, runner.run(batch)):
+            length = len(actual['words'])
+            expected = {'heads': expected['heads'][:length, :length + 1],
+                        'head_tags': expected['head_tags'][:length]}
+            for name in OUTPUTS:
+                max_differences[name] = max(max_differences[name],
+                                            _max_difference(expected[name], actual[name]))
+    logger.info('max absolute differences over %d sentences in batches of %d shapes: %s',
+                len(instances), len(shapes), max_differences)
+    return all(difference <= tolerance for difference in max_differences.values())
+
+
+def _categories(vocab: Vocabulary) -> List[str]:
+    categories = vocab.get_index_to_token_vocabulary('head_tags')
+    categories = [token for _, token in sorted(categories.items())]
+    categories, paddings = categories[2:], categories[:2]
+    assert all(padding in [DEFAULT_PADDING_TOKEN, DEFAULT_OOV_TOKEN] for padding in paddings)
+    return categories
+
+
+def run(archive_file: str, onnx_file: str, input_file: str, batch_size: int = 32, num_threads: int = 0) -> None:
+    """
+    prints the predictions on input_file in the output format of Tree2treePredictor
+    """
+    model, reader = load_model_and_reader(archive_file)
+    runner = OnnxTree2TreeRunner(onnx_file, model.vocab, num_threads)
+    categories = _categories(model.vocab)
+    del model
+    batch: List[Instance] = []
+
+    def flush():
+        for output in runner.run(batch):
+            print(json.dumps({
+                'words': ' '.join(output['words']),
+                'categories': categories,
+                'heads': output['heads'].flatten().astype(float).tolist(),
+                'heads_shape': list(output['heads'].shape),
+                'head_tags': output['head_tags'].flatten().astype(float).tolist(),
+                'head_tags_shape': list(output['head_tags'].shape),
+            }))
+        batch.clear()
+
+    for instance in read_json_instances(reader, input_file):
+        batch.append(instance)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser('export Tree2TreeBiTreeLSTM to ONNX and run it with onnxruntime')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('ARCHIVE', help='model.tar.gz')
+    export_parser.add_argument('INPUT', help='JSON lines file used for tracing (e.g. geometry/geo-train.json)')
+    export_parser.add_argument('OUTPUT')
+    export_parser.add_argument('--batch-size', type=int, default=8)
+    export_parser.add_argument('--opset-version', type=int, default=11)
+    check_parser = subparsers.add_parser('check')
+    check_parser.add_argument('ARCHIVE')
+    check_parser.add_argument('ONNX')
+    check_parser.add_argument('INPUT', nargs='?', default='geometry/geo-train.json')
+    check_parser.add_argument('--batch-size', type=int, default=8)
+    check_parser.add_argument('--tolerance', type=float, default=1e-4)
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('ARCHIVE')
+    run_parser.add_argument('ONNX')
+    run_parser.add_argument('INPUT')
+    run_parser.add_argument('--batch-size', type=int, default=32)
+    run_parser.add_argument('--num-threads', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_onnx(args.ARCHIVE, args.INPUT, args.OUTPUT, args.batch_size, args.opset_version)
+    elif args.command == 'check':
+        if not check_parity(args.ARCHIVE, args.ONNX, args.INPUT, args.batch_size, args.tolerance):
+            raise SystemExit('ONNX outputs differ from the eager model')
+    elif args.command == 'run':
+        run(args.ARCHIVE, args.ONNX, args.INPUT, args.batch_size, args.num_threads)
+    else:
+        parser.print_help()
@@ -1,33 +1,45 @@
+from typing import Optional
 
 import torch
 from torch import nn
-from torch.nn.utils.rnn import pad_sequence
 from allennlp.common import Registrable
-from allennlp.nn.util import get_lengths_from_binary_sequence_mask
-from ud2ccg.allennlp.nn.treelstm import BidirectionalTreeLSTM, ChildSumTreeLSTM
+from ud2ccg.allennlp.nn.treelstm import BidirectionalTreeLSTM, compute_depths_and_heights
 
 
 class BidirectionalTreeLSTMEncoder(Registrable, nn.Module):
-    def __init__(self, in_size: int, out_size: int, dropout: float=0.5) -> None:
+    def __init__(self,
+                 in_size: int,
+                 out_size: int,
+                 dropout: float=0.5,
+                 parallel_directions: bool = False,
+                 checkpoint_levels: bool = False,
+                 legacy_leaf_bias: bool = True) -> None:
         super().__init__()
         assert out_size % 2 == 0
-        self.encoder = BidirectionalTreeLSTM(in_size, out_size // 2, dropout)
-
-    def forward(self, inputs: torch.Tensor, head_indices: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        self.encoder = BidirectionalTreeLSTM(in_size, out_size // 2, dropout,
+                                             parallel_directions, checkpoint_levels, legacy_leaf_bias)
+
+    def forward(self,
+                inputs: torch.Tensor,
+                head_indices: torch.Tensor,
+                mask: torch.Tensor,
+                depths: Optional[torch.Tensor] = None,
+                heights: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         :param inputs: (batchsize, sequence length + 1, unit size)
         :param head_indices: (batchsize, sequence length + 1)
         :param mask: (batchsize, sequence length + 1)
+        :param depths: (batchsize, sequence length + 1) precomputed depths of the nodes, -1 for padding
+        :param heights: (batchsize, sequence length + 1) precomputed heights of the nodes, -1 for padding
         "sequence length + 1" is for a root token.
+        When depths and heights are not given, they are computed from head_indices and mask.
         :return:
+            (batchsize, sequence length + 1, output dim), where padding tokens are zero.
         """
-        lengths = get_lengths_from_binary_sequence_mask(mask)
-        inputs = [x[:length] for x, length in zip(inputs, lengths)]
-        split_head_indices = [list(instance_heads[:length]) for instance_heads, length
-                              in zip(head_indices, lengths)]
-        _, hs = self.encoder(inputs, split_head_indices)
-        results = pad_sequence(hs, batch_first=True)
-        return results
+        if depths is None or heights is None:
+            depths, heights = compute_depths_and_heights(head_indices, mask)
+        _, hs = self.encoder.forward_padded(inputs, head_indices, depths, heights)
+        return hs
 
     def get_output_dim(self):
         return self.encoder.state_size
@@ -3,7 +3,6 @@ import torch
 from allennlp.common import Params
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules.token_embedders.embedding import Embedding
-from allennlp.modules.time_distributed import TimeDistributed
 from allennlp.modules.token_embedders.token_embedder import TokenEmbedder
 
 
@@ -22,9 +21,8 @@ class AfixEmbedding(TokenEmbedder):
 
     def forward(self, token_afixes: torch.Tensor) -> torch.Tensor:
         batchsize, sentence_length, _ = token_afixes.size()
-        embedding = TimeDistributed(self._embedding)
-        embedding = TimeDistributed(embedding)
-        embedded = embedding(token_afixes.unsqueeze(-1))
+        # a single lookup of all the afixes of the batch, as (batchsize, sentence_length * 4)
+        embedded = self._embedding(token_afixes.view(batchsize, -1))
         return self._dropout(embedded.view(batchsize, sentence_length, -1))
 
     # The setdefault requires a custom from_params
@@ -34,3 +34,89 @@ class BilinearWithBias(Module):
         return 'in1_features={}, in2_features={}, out_features={}, bias={}'.format(
             self.in1_features, self.in2_features, self.out_features, self.bias is not None
         )
+
+
+class LowRankBilinearWithBias(Module):
+    """
+    BilinearWithBias whose weight of each output feature is factorized as
+    W[o] = U[o]^T V[o], where U[o] is (rank, in1_features) and V[o] is (rank, in2_features),
+    so that the bilinear term costs O(out_features * rank * (in1_features + in2_features)).
+    """
+    def __init__(self, in1_features, in2_features, out_features, rank):
+        super(LowRankBilinearWithBias, self).__init__()
+        self.in1_features = in1_features
+        self.in2_features = in2_features
+        self.out_features = out_features
+        self.rank = rank
+        self.U = Parameter(torch.Tensor(out_features, rank, in1_features))
+        self.V = Parameter(torch.Tensor(out_features, rank, in2_features))
+        self.V1 = Parameter(torch.Tensor(out_features, in1_features))
+        self.V2 = Parameter(torch.Tensor(out_features, in2_features))
+        self.bias = Parameter(torch.Tensor(out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        stdv = 1. / math.sqrt(self.in1_features)
+        # the entries of U[o]^T V[o] have the same variance as those of BilinearWithBias.W
+        factor_stdv = math.sqrt(stdv * math.sqrt(3. / self.rank))
+        self.U.data.uniform_(-factor_stdv, factor_stdv)
+        self.V.data.uniform_(-factor_stdv, factor_stdv)
+        self.V1.data.uniform_(-stdv, stdv)
+        self.V2.data.uniform_(-stdv, stdv)
+        self.bias.data.uniform_(-stdv, stdv)
+
+    def forward(self, input1, input2):
+        # (..., out_features * rank)
+        projected1 = F.linear(input1, self.U.view(-1, self.in1_features))
+        projected2 = F.linear(input2, self.V.view(-1, self.in2_features))
+        result = (projected1 * projected2).view(*projected1.shape[:-1], self.out_features, self.rank).sum(-1)
+        result += F.linear(input1, self.V1, self.bias)
+        result += F.linear(input2, self.V2, None)
+        return result
+
+    @classmethod
+    def from_full_rank(cls, layer, rank):
+        """
+        approximates a (trained) BilinearWithBias by the truncated SVD of the weight of each output feature.
+        :param layer: BilinearWithBias object
+        :param rank: number of singular values kept
+        :return:
+            LowRankBilinearWithBias object
+        """
+        result = cls(layer.in1_features, layer.in2_features, layer.out_features, rank)
+        state_dict = factorize_bilinear_state_dict(layer.state_dict(), rank)
+        result.load_state_dict(state_dict)
+        return result
+
+    def extra_repr(self):
+        return 'in1_features={}, in2_features={}, out_features={}, rank={}, bias={}'.format(
+            self.in1_features, self.in2_features, self.out_features, self.rank, self.bias is not None
+        )
+
+
+def factorize_bilinear(weight, rank):
+    """
+    :param weight: (out_features, in1_features, in2_features)
+    :param rank: number of singular values kept
+    :return:
+        U: (out_features, rank, in1_features), V: (out_features, rank, in2_features),
+        such that U[o]^T V[o] is the best rank-r approximation of weight[o]
+    """
+    if not 0 < rank <= min(weight.shape[1:]):
+        raise ValueError(f'rank must be in [1, {min(weight.shape[1:])}], but got {rank}')
+    left, singular_values, right = torch.svd(weight.detach())
+    scale = singular_values[:, :rank].sqrt().unsqueeze(1)
+    U = (left[:, :, :rank] * scale).transpose(1, 2).contiguous()
+    V = (right[:, :, :rank] * scale).transpose(1, 2).contiguous()
+    return U, V
+
+
+def factorize_bilinear_state_dict(state_dict, rank, prefix=''):
+    """
+    converts the parameters of a BilinearWithBias (stored under prefix in state_dict)
+    into those of LowRankBilinearWithBias. The other entries are kept as they are.
+    """
+    result = dict(state_dict)
+    weight = result.pop(prefix + 'W')
+    result[prefix + 'U'], result[prefix + 'V'] = factorize_bilinear(weight, rank)
+    return result
@@ -1,10 +1,13 @@
 from overrides import overrides
-from typing import List, Optional, Tuple, Union, Iterator
-from itertools import zip_longest
+from typing import List, Optional, Tuple, Union, Iterator, NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import numpy
 import torch
 from torch import nn
 from torch.nn.modules import Dropout
-from allennlp.common.checks import check_dimensions_match
+from torch.utils.checkpoint import checkpoint
+from ud2ccg.allennlp.data.dependency_tree import TreeArrays, build_tree_arrays, expand_ranges
 
 
 class Node(object):
@@ -12,11 +15,6 @@ class Node(object):
         self.index = index
         self.parent = parent
         self.children = children
-        self.h_in = None
-        self.h_up = None
-        self.c_up = None
-        self.h_down = None
-        self.c_down = None
 
     def __str__(self) -> str:
         if len(self.children) == 0:
@@ -30,23 +28,34 @@ class Node(object):
 
 
 class Tree(object):
-    def __init__(self, root: Node, nodes: List[Node]) -> None:
+    def __init__(self, root: Node, nodes: List[Node], arrays: TreeArrays = None) -> None:
         self.root = root
         self.nodes = nodes
+        self._arrays = arrays
+
+    @property
+    def arrays(self) -> TreeArrays:
+        if self._arrays is None:
+            self._arrays = build_tree_arrays(
+                [-1 if node.parent is None else node.parent.index for node in self.nodes])
+        return self._arrays
 
     def iter_topdown(self) -> Iterator[Node]:
-        def rec(node: Node):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
             yield node
-            for child in node.children:
-                yield from rec(child)
-        yield from rec(self.root)
+            stack.extend(reversed(node.children))
 
     def iter_bottomup(self) -> Iterator[Node]:
-        def rec(node: Node):
-            for child in node.children:
-                yield from rec(child)
-            yield node
-        yield from rec(self.root)
+        stack = [(self.root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
 
     @staticmethod
     def of_list(head_indices: List[int]) -> 'Tree':
@@ -57,56 +66,13 @@ class Tree(object):
         :param head_indices: heads indices where lst[0] = -1
         :return:
         """
-        def rec(parent: Node) -> List[Node]:
-            children = []
-            for child, head in enumerate(head_indices):
-                if head == parent.index:
-                    child_node = Node(child, parent, [])
-                    child_node.children = rec(child_node)
-                    nodes[child] = child_node
-                    children.append(child_node)
-            return children
-
-        nodes = [None for _ in head_indices]
-        root = Node(0, None, [])
-        root.children = rec(root)
-        nodes[0] = root
-        assert all(node is not None for node in nodes)
-        return Tree(root, nodes)
-
-    def assign_variables(self, hs: List[torch.Tensor]) -> None:
-        """str(
-        :param hs: a list of Variable objects whose sizes are (1, hidden_units)
-        :return:
-        """
-        check_dimensions_match(len(hs), len(self.nodes),
-                               'number of hidden vectors', 'number of nodes')
-        for h, node in zip(hs, self.nodes):
-            node.h_in = h
-
-    def collect_variables(self):
-        """
-        :return:
-        hs_up, hs_down, cs_up, cs_down: All (len(self.nodes), hidden_units)
-        """
-        hs_up, hs_down, cs_up, cs_down = \
-            zip(*[(node.h_up, node.h_down, node.c_up, node.c_down) for node in self.nodes])
-        hs_up = torch.cat(hs_up, dim=0)
-        hs_down = torch.cat(hs_down, dim=0)
-        cs_up = torch.cat(cs_up, dim=0)
-        cs_down = torch.cat(cs_down, dim=0)
-        return hs_up, hs_down, cs_up, cs_down
-
-
-def split_into_batches(hs: torch.Tensor) -> List[torch.Tensor]:
-    """
-    :param hs: (batchsize, hidden_units)
-    :return:
-        a list of Variable's whose sizes are (1, hidden_units)
-    """
-    batchsize, _ = hs.shape
-    res = torch.split(hs, 1, 0)
-    return res
+        arrays = build_tree_arrays(head_indices)
+        nodes = [Node(index, None, []) for index in range(len(arrays))]
+        for node, start, end in zip(nodes, arrays.child_offsets[:-1], arrays.child_offsets[1:]):
+            node.children = [nodes[child] for child in arrays.children[start:end]]
+            for child in node.children:
+                child.parent = node
+        return Tree(nodes[0], nodes, arrays)
 
 
 def make_trees(indices_or_trees: List[List[int]]) -> List[Tree]:
@@ -124,16 +90,292 @@ def make_trees(indices_or_trees: List[List[int]]) -> List[Tree]:
     return trees
 
 
-def _transpose_lists_with_padding(xs, padding):
+def make_tree_arrays(indices_or_trees: List[Union[List[int], Tree, TreeArrays]]) -> List[TreeArrays]:
+    """
+    :param indices_or_trees: a batch of lists of head indices, Tree or TreeArrays objects
+    :return:
+        a list of TreeArrays objects
+    """
+    arrays = []
+    for i_or_t in indices_or_trees:
+        if isinstance(i_or_t, Tree):
+            arrays.append(i_or_t.arrays)
+        elif isinstance(i_or_t, TreeArrays):
+            arrays.append(i_or_t)
+        else:
+            arrays.append(build_tree_arrays(i_or_t))
+    return arrays
+
+
+class TreeSchedule(NamedTuple):
+    """
+    level-synchronous traversal order over a batch of trees.
+    the nodes of all the trees are numbered consecutively (tree by tree),
+    so that the states can be kept in (num_nodes + 1, hidden_units) buffers,
+    where the last row stays zero and is used for padding.
+    topdown: for each depth, (nodes, their parents)
+    bottomup: for each height, (nodes, their children, positions of the children's parents in nodes)
+    leaf_bias: (number of leaves,) whether each leaf in bottomup[0] gets the bias of W_h_aio
+    (see legacy_leaf_bias_mask), empty when not computed
+    """
+    num_nodes: int
+    lengths: List[int]
+    topdown: List[Tuple[torch.Tensor, torch.Tensor]]
+    bottomup: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
+    leaf_bias: torch.Tensor
+
+
+def _group_by(levels: numpy.ndarray) -> List[numpy.ndarray]:
+    order = numpy.argsort(levels, kind='stable')
+    return numpy.split(order, numpy.cumsum(numpy.bincount(levels))[:-1])
+
+
+def legacy_leaf_bias_mask(heads: torch.Tensor,
+                          depths: torch.Tensor,
+                          heights: torch.Tensor,
+                          nodes: torch.Tensor,
+                          topdown: List[torch.Tensor],
+                          bottomup: List[torch.Tensor],
+                          max_length: int) -> torch.Tensor:
     """
-    transpose a list of lists of Variable objects.
-    When the lists are uneven in their length, xp.zeros are padded in the place.
-    :param xs: a list of lists of Variable
+    the original implementation visited the k-th node in postorder of every tree of the batch
+    at step k, and the children of the nodes in a step were padded with zero vectors.
+    so a leaf got the bias of W_h_aio (through its zero children) when another node
+    of its step had children, which is reproduced with this mask.
+    :param heads: (num_nodes,) head of each node, num_nodes for the roots
+    :param depths: (num_nodes,) depth of each node
+    :param heights: (num_nodes,) height of each node
+    :param nodes: the nodes that are not padding
+    :param topdown: nodes of each depth
+    :param bottomup: nodes of each height
+    :param max_length: number of nodes of the largest tree
     :return:
+        (len(bottomup[0]),) whether each leaf gets the bias
     """
-    # tensor = xs[0][0]
-    # padding = tensor.new_zeros(tensor.size())
-    return tuple(torch.cat(x, dim=0) for x in zip_longest(*xs, fillvalue=padding))
+    num_nodes = heads.size(0)
+    sizes = torch.ones(num_nodes + 1, dtype=torch.long, device=heads.device)
+    for level in bottomup:
+        sizes.index_add_(0, heads[level], sizes[level])
+
+    # a child comes after its parent and the subtrees of its preceding siblings in preorder
+    children = nodes[heads[nodes] < num_nodes]
+    _, order = (heads[children] * num_nodes + children).sort()
+    children = children[order]
+    parents = heads[children]
+    child_sizes = sizes[children]
+    totals = torch.zeros_like(sizes).index_add_(0, parents, child_sizes)
+    offsets = torch.zeros_like(sizes)
+    offsets[children] = 1 + child_sizes.cumsum(0) - child_sizes - (totals.cumsum(0) - totals)[parents]
+    preorder = torch.zeros_like(sizes)
+    for level in topdown[1:]:
+        preorder[level] = preorder[heads[level]] + offsets[level]
+    postorder = preorder[:num_nodes] - depths + sizes[:num_nodes] - 1
+
+    inner_nodes = nodes[heights[nodes] > 0]
+    steps_with_children = torch.zeros(max_length, dtype=torch.long, device=heads.device)
+    steps_with_children.index_fill_(0, postorder[inner_nodes], 1)
+    return steps_with_children[postorder[bottomup[0]]] > 0
+
+
+def make_schedule(trees: List[TreeArrays],
+                  device: torch.device = None,
+                  legacy_leaf_bias: bool = False) -> TreeSchedule:
+    """
+    groups the nodes in a batch of trees by their depth (for top-down traversal)
+    and by their height (for bottom-up traversal), so that the number of sequential
+    steps is the depth of the deepest tree, not the length of the longest sentence.
+    :param trees: a list of TreeArrays objects
+    :param device: device on which the index tensors are put
+    :param legacy_leaf_bias: compute TreeSchedule.leaf_bias
+    :return:
+        TreeSchedule object
+    """
+    lengths = [len(tree) for tree in trees]
+    num_nodes = sum(lengths)
+    node_offsets = numpy.cumsum([0] + lengths)
+    child_bases = numpy.cumsum([0] + [len(tree.children) for tree in trees])
+
+    heads = numpy.concatenate([tree.heads + offset for tree, offset in zip(trees, node_offsets)])
+    heads[node_offsets[:-1]] = num_nodes
+    children = numpy.concatenate([tree.children + offset for tree, offset in zip(trees, node_offsets)])
+    child_offsets = numpy.concatenate([tree.child_offsets[:-1] + base for tree, base in zip(trees, child_bases)]
+                                      + [child_bases[-1:]])
+    depth = numpy.concatenate([tree.depth for tree in trees])
+    height = numpy.concatenate([tree.height for tree in trees])
+
+    def as_tensor(indices: numpy.ndarray) -> torch.Tensor:
+        return torch.from_numpy(indices).to(device)
+
+    def children_of(nodes: numpy.ndarray) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        starts = child_offsets[nodes]
+        counts = child_offsets[nodes + 1] - starts
+        return (as_tensor(nodes),
+                as_tensor(children[expand_ranges(starts, counts)]),
+                as_tensor(numpy.repeat(numpy.arange(len(nodes)), counts)))
+
+    topdown = _group_by(depth)
+    bottomup = _group_by(height)
+    if legacy_leaf_bias:
+        leaf_bias = legacy_leaf_bias_mask(as_tensor(heads), as_tensor(depth), as_tensor(height),
+                                          as_tensor(numpy.arange(num_nodes)),
+                                          [as_tensor(nodes) for nodes in topdown],
+                                          [as_tensor(nodes) for nodes in bottomup],
+                                          max(lengths))
+    else:
+        leaf_bias = torch.zeros(0, dtype=torch.bool, device=device)
+    return TreeSchedule(
+        num_nodes,
+        lengths,
+        [(as_tensor(nodes), as_tensor(heads[nodes])) for nodes in topdown],
+        [children_of(nodes) for nodes in bottomup],
+        leaf_bias)
+
+
+def compute_depths_and_heights(head_indices: torch.Tensor,
+                               mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    computes the depth and height of every node in a padded batch of trees with tensor operations
+    (used when they are not precomputed by the dataset reader).
+    depths are found by pointer jumping in O(log(sequence length)) steps, and heights by
+    propagating "has a child of height >= t" upwards in O(max depth) steps.
+    :param head_indices: (batchsize, sequence length), where the root's is -1
+    :param mask: (batchsize, sequence length)
+    :return:
+        depths, heights: (batchsize, sequence length), -1 for padding
+    """
+    mask = mask != 0
+    _, sequence_length = head_indices.size()
+    head_indices = head_indices.long()
+    is_child = mask & (head_indices >= 0)
+    # the root (and padding) points to the root itself
+    parents = head_indices.clamp(min=0).masked_fill(~mask, 0)
+
+    depths = is_child.long()
+    pointers = parents
+    steps = 1
+    while steps < sequence_length:
+        depths = depths + depths.gather(1, pointers)
+        pointers = pointers.gather(1, pointers)
+        steps *= 2
+
+    heights = torch.zeros_like(depths)
+    at_least = is_child
+    for _ in range(int(depths.max())):
+        has_child = heights.new_zeros(heights.size()).scatter_add_(1, parents, at_least.long()) > 0
+        heights = heights + has_child.long()
+        at_least = has_child & is_child
+
+    return depths.masked_fill(~mask, -1), heights.masked_fill(~mask, -1)
+
+
+def _split_by_level(nodes: torch.Tensor,
+                    levels: torch.Tensor,
+                    num_nodes: int,
+                    num_levels: int = 0) -> List[torch.Tensor]:
+    """
+    sorts nodes by (level, index) and splits them into levels
+    """
+    _, order = (levels * num_nodes + nodes).sort()
+    counts: List[int] = torch.bincount(levels, minlength=num_levels).tolist()
+    return list(torch.split(nodes[order], counts))
+
+
+def make_padded_schedule(head_indices: torch.Tensor,
+                         depths: torch.Tensor,
+                         heights: torch.Tensor,
+                         legacy_leaf_bias: bool = False) -> TreeSchedule:
+    """
+    same as make_schedule, but reads padded tensors (e.g. those precomputed by the dataset reader),
+    where node j of the i-th tree is numbered i * sequence length + j.
+    :param head_indices: (batchsize, sequence length) head indices, where the root's is -1
+    :param depths: (batchsize, sequence length) depth of each node, -1 for padding
+    :param heights: (batchsize, sequence length) height of each node, -1 for padding
+    :param legacy_leaf_bias: compute TreeSchedule.leaf_bias
+    :return:
+        TreeSchedule object
+    """
+    batch_size, sequence_length = head_indices.size()
+    num_nodes = batch_size * sequence_length
+    device = head_indices.device
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1) * sequence_length
+    heads = (head_indices.long() + offsets).masked_fill(head_indices < 0, num_nodes).view(-1)
+    depths = depths.long().view(-1)
+    heights = heights.long().view(-1)
+    nodes = (depths >= 0).nonzero().view(-1)
+
+    topdown = _split_by_level(nodes, depths[nodes], num_nodes)
+    bottomup = _split_by_level(nodes, heights[nodes], num_nodes)
+    positions = torch.zeros_like(heads)
+    for level in bottomup:
+        positions[level] = torch.arange(len(level), device=device)
+    children = nodes[heads[nodes] < num_nodes]
+    children = _split_by_level(children, heights[heads[children]], num_nodes, len(bottomup))
+    if legacy_leaf_bias:
+        leaf_bias = legacy_leaf_bias_mask(heads, depths, heights, nodes, topdown, bottomup, sequence_length)
+    else:
+        leaf_bias = torch.zeros(0, dtype=torch.bool, device=device)
+    return TreeSchedule(
+        num_nodes,
+        [sequence_length] * batch_size,
+        [(level, heads[level]) for level in topdown],
+        [(level, level_children, positions[heads[level_children]])
+         for level, level_children in zip(bottomup, children)],
+        leaf_bias)
+
+
+class DenseTreeSchedule(NamedTuple):
+    """
+    TreeSchedule padded into rectangular tensors, so that the traversal can be written
+    as a loop over levels with fixed-rank inputs (e.g. for ONNX export).
+    nodes are padded with num_nodes + 1 (a scratch row whose contents are discarded),
+    and parents and children with num_nodes (the zero row).
+    the first bottom-up level is always the leaves.
+    topdown_nodes, topdown_parents: (number of depths, max level width)
+    bottomup_nodes: (number of heights, max level width)
+    bottomup_children: (number of heights, max level width, max number of children)
+    leaf_bias: (max level width,) TreeSchedule.leaf_bias, padded with False
+    """
+    topdown_nodes: torch.Tensor
+    topdown_parents: torch.Tensor
+    bottomup_nodes: torch.Tensor
+    bottomup_children: torch.Tensor
+    leaf_bias: torch.Tensor
+
+
+def make_dense_schedule(schedule: TreeSchedule) -> DenseTreeSchedule:
+    """
+    :param schedule: TreeSchedule object
+    :return:
+        DenseTreeSchedule object
+    """
+    num_nodes = schedule.num_nodes
+    device = schedule.topdown[0][0].device
+    width = max(len(level[0]) for level in schedule.topdown + schedule.bottomup)
+    topdown_nodes = torch.full((len(schedule.topdown), width), num_nodes + 1, dtype=torch.long, device=device)
+    topdown_parents = torch.full_like(topdown_nodes, num_nodes)
+    for level, (nodes, parents) in enumerate(schedule.topdown):
+        topdown_nodes[level, :len(nodes)] = nodes
+        topdown_parents[level, :len(nodes)] = parents
+
+    levels = []
+    for nodes, children, child_parents in schedule.bottomup:
+        # rank of each child among its siblings
+        _, order = (child_parents * num_nodes + children).sort()
+        children, child_parents = children[order], child_parents[order]
+        counts = torch.bincount(child_parents, minlength=len(nodes))
+        starts = counts.cumsum(0) - counts
+        ranks = torch.arange(len(children), device=device) - starts[child_parents]
+        levels.append((nodes, children, child_parents, ranks, int(counts.max()) if len(nodes) > 0 else 0))
+    max_children = max(max_count for *_, max_count in levels)
+    bottomup_nodes = torch.full((len(levels), width), num_nodes + 1, dtype=torch.long, device=device)
+    bottomup_children = torch.full((len(levels), width, max_children), num_nodes,
+                                   dtype=torch.long, device=device)
+    for level, (nodes, children, child_parents, ranks, _) in enumerate(levels):
+        bottomup_nodes[level, :len(nodes)] = nodes
+        bottomup_children[level, child_parents, ranks] = children
+    leaf_bias = torch.zeros(width, dtype=torch.bool, device=device)
+    leaf_bias[:len(schedule.leaf_bias)] = schedule.leaf_bias
+    return DenseTreeSchedule(topdown_nodes, topdown_parents, bottomup_nodes, bottomup_children, leaf_bias)
 
 
 def _pad_zero_nodes(vs: List[torch.Tensor], padding: torch.Tensor):
@@ -152,6 +394,7 @@ class ChildSumTreeLSTM(nn.Module):
         self.W_h_aio = torch.nn.Linear(out_size, 3 * out_size, bias=True)
         self.W_h_f = torch.nn.Linear(out_size, out_size, bias=True)
 
+    @torch.jit.unused
     @overrides
     def forward(self, *cshsx):
         cs = cshsx[:len(cshsx) // 2]
@@ -201,80 +444,344 @@ class ChildSumTreeLSTM(nn.Module):
         h = torch.sigmoid(o) * torch.tanh(c)
         return c, h
 
+    def project(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        input-to-gate projections, which can be computed for all the nodes at once before traversal.
+        :param x: (number of nodes, in_size)
+        :return:
+            (number of nodes, 4 * out_size)
+        """
+        return self.W_x(x)
+
+    def aggregate(self,
+                  x_in: torch.Tensor,
+                  cs: torch.Tensor,
+                  hs: torch.Tensor,
+                  parents: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        same as forward, but the children of all the nodes come in flat tensors,
+        so that the cost does not depend on the number of children of each node.
+        :param x_in: (number of nodes, 4 * out_size) projected inputs (see project)
+        :param cs: (number of children, out_size) cell states of the children
+        :param hs: (number of children, out_size) hidden states of the children
+        :param parents: (number of children,) position in x_in of the parent of each child
+        :return:
+            c, h: (number of nodes, out_size)
+        """
+        x_aio_in, x_f_in = torch.split(x_in, [3 * self.out_size, self.out_size], dim=1)
+
+        if hs.size(0) == 0:
+            a, i, o = torch.split(x_aio_in, self.out_size, dim=1)
+            c = torch.sigmoid(i) * torch.tanh(a)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            return c, h
+
+        zeros = x_in.new_zeros(x_in.size(0), self.out_size)
+        aio_in = self.W_h_aio(zeros.index_add(0, parents, hs)) + x_aio_in
+        f = torch.sigmoid(self.W_h_f(hs) + x_f_in.index_select(0, parents))
+
+        a, i, o = torch.split(aio_in, self.out_size, dim=1)
+        c = zeros.index_add(0, parents, f * cs) + torch.sigmoid(i) * torch.tanh(a)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return c, h
+
+    def aggregate_padded(self,
+                         x_in: torch.Tensor,
+                         cs: torch.Tensor,
+                         hs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        same as forward, but the children come in padded tensors, where padded children are zero vectors.
+        :param x_in: (number of nodes, 4 * out_size) projected inputs (see project)
+        :param cs: (number of nodes, max number of children, out_size) cell states of the children
+        :param hs: (number of nodes, max number of children, out_size) hidden states of the children
+        :return:
+            c, h: (number of nodes, out_size)
+        """
+        x_aio_in, x_f_in = torch.split(x_in, [3 * self.out_size, self.out_size], dim=1)
+
+        if hs.size(1) == 0:
+            a, i, o = torch.split(x_aio_in, self.out_size, dim=1)
+            c = torch.sigmoid(i) * torch.tanh(a)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            return c, h
+
+        aio_in = self.W_h_aio(hs.sum(1)) + x_aio_in
+        f = torch.sigmoid(self.W_h_f(hs) + x_f_in.unsqueeze(1))
+
+        a, i, o = torch.split(aio_in, self.out_size, dim=1)
+        c = (f * cs).sum(1) + torch.sigmoid(i) * torch.tanh(a)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return c, h
+
+    def leaf_bias(self, mask: torch.Tensor) -> torch.Tensor:
+        """
+        :param mask: (number of nodes,) whether each node gets the bias
+        :return:
+            (number of nodes, 4 * out_size) the bias of W_h_aio (and zeros for the forget gate)
+            for the nodes in mask, to be added to their projected inputs
+        """
+        bias = torch.cat([self.W_h_aio.bias, self.W_h_aio.bias.new_zeros([self.out_size])])
+        return mask.unsqueeze(1).to(bias.dtype) * bias
+
+
+_DIRECTION_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def _direction_executor() -> ThreadPoolExecutor:
+    global _DIRECTION_EXECUTOR
+    if _DIRECTION_EXECUTOR is None:
+        _DIRECTION_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='treelstm')
+    return _DIRECTION_EXECUTOR
+
+
+# the non-reentrant implementation (where available) also works when no input requires grad
+_CHECKPOINT_OPTIONS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
 
 class BidirectionalTreeLSTM(nn.Module):
-    def __init__(self, in_size: int, out_size: int, dropout: float) -> None:
+    def __init__(self,
+                 in_size: int,
+                 out_size: int,
+                 dropout: float,
+                 parallel_directions: bool = False,
+                 checkpoint_levels: bool = False,
+                 legacy_leaf_bias: bool = True) -> None:
         """
         :param in_size: dimensionality of input vectors
         :param out_size: dimensionality of hidden states and output vectors
         :param dropout: dropout ratio
+        :param parallel_directions: if True, run the top-down and bottom-up passes
+            concurrently, the latter in a worker thread (serially when checkpoint_levels is in effect)
+        :param checkpoint_levels: if True, do not keep the activations of each tree level
+            for the backward pass but recompute them, which trades compute for memory
+            on long sentences (only in training)
+        :param legacy_leaf_bias: if True, a leaf gets the bias of W_h_aio of the bottom-up LSTM
+            when the original node-by-node traversal visited it together with a node
+            that has children (see legacy_leaf_bias_mask), so that the outputs of the models trained
+            with it are unchanged. The bias then depends on the other trees in the batch.
+            If False, no leaf gets it, which is cheaper and independent of the batch.
         """
         super().__init__()
         self.in_size = in_size
         self.state_size = out_size
+        self.parallel_directions = parallel_directions
+        self.checkpoint_levels = checkpoint_levels
+        self.legacy_leaf_bias = legacy_leaf_bias
         if dropout == 0.0:
-            self._dropout = lambda x: x
+            self._dropout = nn.Identity()
         else:
             self._dropout = Dropout(dropout)
         self._topdown_lstm = ChildSumTreeLSTM(in_size, out_size)
         self._bottomup_lstm = ChildSumTreeLSTM(in_size, out_size)
 
+    @torch.jit.unused
     @overrides
     def forward(self,
                 xs: List[torch.Tensor],
                 head_indices: List[List[int]]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
         """
-        :param head_indices: a list of lists of head indices
+        :param head_indices: a list of lists of head indices (or Tree, TreeArrays objects)
         :param xs: a list of batch size of Variable's whose sizes are (sentence length, self.in_size)
         :return:
             cs, hs, lists of the concatenation of top-down, bottom-up LSTM state variables.
             The shape of each Variable object is (sentence length, self.state_size * 2).
         """
-        padding = xs[0].new_zeros(1, self.state_size)
-        trees = make_trees(head_indices)
+        trees = make_tree_arrays(head_indices)
         assert len(xs) == len(trees)
-        for x, tree in zip(xs, trees):
-            tree.assign_variables([tensor.unsqueeze(0) for tensor in x])
-
-        topdown_nodes = zip_longest(*[tree.iter_topdown() for tree in trees])
-        bottomup_nodes = zip_longest(*[tree.iter_bottomup() for tree in trees])
-        for nodes in topdown_nodes:
-            # node.parent can be None
-            nodes, xs, hs, cs = \
-                zip(*[(node,
-                       node.h_in,
-                       node.parent.h_down if node.parent is not None else padding,
-                       node.parent.c_down if node.parent is not None else padding)
-                      for node in nodes if node is not None])
-            xs = torch.cat(xs, dim=0)
-            cs = torch.cat(cs, dim=0)
-            hs = torch.cat(hs, dim=0)
-            c_new, h_new = self._topdown_lstm(cs, hs, xs)
-            c_new = self._dropout(c_new)
-            h_new = self._dropout(h_new)
-            for node, c_, h_ in zip(nodes, split_into_batches(c_new), split_into_batches(h_new)):
-                node.c_down = c_
-                node.h_down = h_
-
-        for nodes in bottomup_nodes:
-            # node.children can be empty
-            nodes, xs, hs, cs = \
-                zip(*[(node,
-                       node.h_in,
-                       [child.h_up for child in node.children],
-                       [child.c_up for child in node.children])
-                      for node in nodes if node is not None])
-            xs = torch.cat(xs, dim=0)
-            cs = _transpose_lists_with_padding(cs, padding)
-            hs = _transpose_lists_with_padding(hs, padding)
-            c_new, h_new = self._bottomup_lstm(*(cs + hs + (xs,)))
-            c_new = self._dropout(c_new)
-            h_new = self._dropout(h_new)
-            for node, c_, h_ in zip(nodes, split_into_batches(c_new), split_into_batches(h_new)):
-                node.c_up = c_
-                node.h_up = h_
-
-        hs_up, hs_down, cs_up, cs_down = zip(*[tree.collect_variables() for tree in trees])
-        hs = [torch.cat(list(vs), dim=1) for vs in zip(hs_up, hs_down)]
-        cs = [torch.cat(list(vs), dim=1) for vs in zip(cs_up, cs_down)]
+        schedule = make_schedule(trees, xs[0].device, self.legacy_leaf_bias)
+        cs, hs = self._encode(torch.cat(xs, dim=0), schedule)
+        return list(torch.split(cs, schedule.lengths)), list(torch.split(hs, schedule.lengths))
+
+    def forward_padded(self,
+                       xs: torch.Tensor,
+                       head_indices: torch.Tensor,
+                       depths: torch.Tensor,
+                       heights: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param xs: (batchsize, sequence length, self.in_size)
+        :param head_indices: (batchsize, sequence length), where the root's is -1
+        :param depths: (batchsize, sequence length) depth of each node, -1 for padding
+        :param heights: (batchsize, sequence length) height of each node, -1 for padding
+        :return:
+            cs, hs: (batchsize, sequence length, self.state_size * 2),
+            where the states of padding tokens are zero.
+        """
+        batch_size, sequence_length, _ = xs.size()
+        schedule = make_padded_schedule(head_indices, depths, heights, self.legacy_leaf_bias)
+        cs, hs = self._encode(xs.contiguous().view(batch_size * sequence_length, -1), schedule)
+        return cs.view(batch_size, sequence_length, -1), hs.view(batch_size, sequence_length, -1)
+
+    @torch.jit.export
+    def forward_dense(self,
+                      xs: torch.Tensor,
+                      topdown_nodes: torch.Tensor,
+                      topdown_parents: torch.Tensor,
+                      bottomup_nodes: torch.Tensor,
+                      bottomup_children: torch.Tensor,
+                      leaf_bias: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        same as forward_padded, but driven by the tensors of a DenseTreeSchedule,
+        so that the traversal is a loop over the levels of fixed-rank inputs (used for ONNX export).
+        the states are updated out of place with scatter.
+        :param xs: (batchsize, sequence length, self.in_size)
+        :return:
+            cs, hs: (batchsize, sequence length, self.state_size * 2)
+        """
+        batch_size, sequence_length, in_size = xs.size()
+        num_nodes = batch_size * sequence_length
+        # append the zero row and the scratch row
+        xs = torch.cat([xs.reshape(num_nodes, in_size), xs.new_zeros([2, in_size])], dim=0)
+        zeros = xs.new_zeros([num_nodes + 2, self.state_size])
+
+        xs_in = self._topdown_lstm.project(xs)
+        c_down, h_down = zeros, zeros
+        for level in range(topdown_nodes.size(0)):
+            nodes = topdown_nodes[level]
+            parents = topdown_parents[level].unsqueeze(1)
+            c_new, h_new = self._topdown_lstm.aggregate_padded(xs_in[nodes], c_down[parents], h_down[parents])
+            index = nodes.unsqueeze(1).expand(-1, self.state_size)
+            c_down = c_down.scatter(0, index, self._dropout(c_new))
+            h_down = h_down.scatter(0, index, self._dropout(h_new))
+
+        xs_in = self._bottomup_lstm.project(xs)
+        c_up, h_up = zeros, zeros
+        for level in range(bottomup_nodes.size(0)):
+            nodes = bottomup_nodes[level]
+            children = bottomup_children[level]
+            x_in = xs_in[nodes]
+            if level == 0:
+                # leaves
+                children = children[:, :0]
+                if self.legacy_leaf_bias:
+                    x_in = x_in + self._bottomup_lstm.leaf_bias(leaf_bias)
+            c_new, h_new = self._bottomup_lstm.aggregate_padded(x_in, c_up[children], h_up[children])
+            index = nodes.unsqueeze(1).expand(-1, self.state_size)
+            c_up = c_up.scatter(0, index, self._dropout(c_new))
+            h_up = h_up.scatter(0, index, self._dropout(h_new))
+
+        hs = torch.cat([h_up, h_down], dim=1)[:num_nodes]
+        cs = torch.cat([c_up, c_down], dim=1)[:num_nodes]
+        return cs.view(batch_size, sequence_length, -1), hs.view(batch_size, sequence_length, -1)
+
+    def _encode(self, xs: torch.Tensor, schedule: TreeSchedule) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param xs: (schedule.num_nodes, self.in_size)
+        :param schedule: TreeSchedule object
+        :return:
+            cs, hs: (schedule.num_nodes, self.state_size * 2)
+        """
+        # the levels checkpointed in the two threads would draw their dropout masks from the global RNG
+        # in an interleaving that the recomputation does not replay, so they run one after the other then.
+        if self.parallel_directions and not self._checkpointing():
+            # the two passes only share xs, so they can run at the same time.
+            if torch.jit.is_scripting():
+                bottomup = torch.jit.fork(self._bottomup, xs, schedule)
+                c_down, h_down = self._topdown(xs, schedule)
+                c_up, h_up = torch.jit.wait(bottomup)
+            else:
+                c_down, h_down, c_up, h_up = self._encode_in_threads(xs, schedule)
+        else:
+            c_down, h_down = self._topdown(xs, schedule)
+            c_up, h_up = self._bottomup(xs, schedule)
+
+        hs = torch.cat([h_up, h_down], dim=1)[:-1]
+        cs = torch.cat([c_up, c_down], dim=1)[:-1]
         return cs, hs
+
+    def _topdown(self, xs: torch.Tensor, schedule: TreeSchedule) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return:
+            c_down, h_down: (schedule.num_nodes + 1, self.state_size),
+            where the last row is a zero vector used for padding
+        """
+        c_down, h_down = [xs.new_zeros(schedule.num_nodes + 1, self.state_size) for _ in range(2)]
+        # one large matmul for all the nodes, instead of one per level
+        xs_in = self._topdown_lstm.project(xs)
+        for nodes, parents in schedule.topdown:
+            # each node has its parent as the only "child"
+            level_inputs = (xs_in.index_select(0, nodes),
+                            c_down.index_select(0, parents),
+                            h_down.index_select(0, parents),
+                            torch.arange(len(nodes), device=nodes.device))
+            if self._checkpointing() and not torch.jit.is_scripting():
+                c_new, h_new = self._checkpointed_level(True, *level_inputs)
+            else:
+                c_new, h_new = self._topdown_level(*level_inputs)
+            c_down.index_copy_(0, nodes, c_new)
+            h_down.index_copy_(0, nodes, h_new)
+        return c_down, h_down
+
+    def _bottomup(self, xs: torch.Tensor, schedule: TreeSchedule) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return:
+            c_up, h_up: (schedule.num_nodes + 1, self.state_size),
+            where the last row is a zero vector used for padding
+        """
+        c_up, h_up = [xs.new_zeros(schedule.num_nodes + 1, self.state_size) for _ in range(2)]
+        xs_in = self._bottomup_lstm.project(xs)
+        for level, (nodes, children, child_parents) in enumerate(schedule.bottomup):
+            # leaves come all together in the first step, where children is empty
+            x_in = xs_in.index_select(0, nodes)
+            if level == 0 and self.legacy_leaf_bias:
+                x_in = x_in + self._bottomup_lstm.leaf_bias(schedule.leaf_bias)
+            level_inputs = (x_in,
+                            c_up.index_select(0, children),
+                            h_up.index_select(0, children),
+                            child_parents)
+            if self._checkpointing() and not torch.jit.is_scripting():
+                c_new, h_new = self._checkpointed_level(False, *level_inputs)
+            else:
+                c_new, h_new = self._bottomup_level(*level_inputs)
+            c_up.index_copy_(0, nodes, c_new)
+            h_up.index_copy_(0, nodes, h_new)
+        return c_up, h_up
+
+    def _topdown_level(self,
+                       x_in: torch.Tensor,
+                       cs: torch.Tensor,
+                       hs: torch.Tensor,
+                       parents: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        c_new, h_new = self._topdown_lstm.aggregate(x_in, cs, hs, parents)
+        return self._dropout(c_new), self._dropout(h_new)
+
+    def _bottomup_level(self,
+                        x_in: torch.Tensor,
+                        cs: torch.Tensor,
+                        hs: torch.Tensor,
+                        parents: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        c_new, h_new = self._bottomup_lstm.aggregate(x_in, cs, hs, parents)
+        return self._dropout(c_new), self._dropout(h_new)
+
+    def _checkpointing(self) -> bool:
+        return self.checkpoint_levels and self.training and torch.is_grad_enabled()
+
+    @torch.jit.unused
+    def _checkpointed_level(self,
+                            topdown: bool,
+                            x_in: torch.Tensor,
+                            cs: torch.Tensor,
+                            hs: torch.Tensor,
+                            parents: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # only the inputs of the level are kept, and the gates are recomputed in backward.
+        # the RNG state is restored on recomputation, so that the same dropout masks are used.
+        level = self._topdown_level if topdown else self._bottomup_level
+        return checkpoint(level, x_in, cs, hs, parents, **_CHECKPOINT_OPTIONS)
+
+    @torch.jit.unused
+    def _encode_in_threads(self,
+                           xs: torch.Tensor,
+                           schedule: TreeSchedule) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        # grad mode is thread local and has to be passed on to the worker.
+        bottomup = _direction_executor().submit(
+            self._bottomup_in_grad_mode, torch.is_grad_enabled(), xs, schedule)
+        c_down, h_down = self._topdown(xs, schedule)
+        c_up, h_up = bottomup.result()
+        return c_down, h_down, c_up, h_up
+
+    @torch.jit.unused
+    def _bottomup_in_grad_mode(self,
+                               grad_enabled: bool,
+                               xs: torch.Tensor,
+                               schedule: TreeSchedule) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.set_grad_enabled(grad_enabled):
+            return self._bottomup(xs, schedule)
@@ -0,0 +1,268 @@
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+from concurrent.futures import Future
+import argparse
+import collections
+import json
+import logging
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import numpy
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class LatencyStats:
+    """
+    counters of a MicroBatcher, where the latencies (from submission to result, in milliseconds)
+    are those of the last window requests.
+    """
+    def __init__(self, window: int = 10000) -> None:
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+
+    def add_batch(self, latencies: List[float], failed: bool = False) -> None:
+        with self._lock:
+            self._latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+            self.errors += len(latencies) if failed else 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = numpy.array(self._latencies)
+            requests, batches, errors = self.requests, self.batches, self.errors
+        p50, p99 = numpy.percentile(latencies, [50, 99]).tolist() if len(latencies) > 0 else (None, None)
+        return {'requests': requests,
+                'batches': batches,
+                'errors': errors,
+                'mean_batch_size': requests / batches if batches else None,
+                'p50_ms': p50,
+                'p99_ms': p99}
+
+
+class MicroBatcher:
+    """
+    runs predictor.predict_batch_json in a background thread on micro-batches of the requests
+    submitted concurrently: a batch is run when it has max_batch_size requests, or max_wait_ms
+    after its first request arrived, whichever comes first.
+    :param predictor: Tree2treePredictor (or any allennlp Predictor)
+    :param max_batch_size: maximum number of requests in a batch
+    :param max_wait_ms: maximum time a request waits for others to join its batch
+    """
+    def __init__(self, predictor, max_batch_size: int = 32, max_wait_ms: float = 5.0) -> None:
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = LatencyStats()
+        self._queue: 'queue.Queue[Optional[Tuple[Dict[str, Any], Future, float]]]' = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, json_dict: Dict[str, Any]) -> Future:
+        """
+        :return:
+            a Future of the output of the predictor for json_dict
+        """
+        future: Future = Future()
+        self._queue.put((json_dict, future, time.perf_counter()))
+        return future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def statistics(self) -> Dict[str, Any]:
+        statistics = dict(self.stats.as_dict(), queue_depth=self.queue_depth())
+        if getattr(self.predictor, 'cache_statistics', None) is not None:
+            statistics['cache'] = self.predictor.cache_statistics()
+        return statistics
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = item[2] + self.max_wait
+            closing = False
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+            if closing:
+                return
+
+    def _run_batch(self, batch: List[Tuple[Dict[str, Any], Future, float]]) -> None:
+        try:
+            outputs = self.predictor.predict_batch_json([json_dict for json_dict, _, _ in batch])
+        except Exception as error:  # pylint: disable=broad-except
+            if len(batch) > 1:
+                # retry one by one, so that a bad request does not fail the others
+                for item in batch:
+                    self._run_batch([item])
+                return
+            logger.exception('failed to predict a request')
+            now = time.perf_counter()
+            self.stats.add_batch([(now - start) * 1000 for _, _, start in batch], failed=True)
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        now = time.perf_counter()
+        self.stats.add_batch([(now - start) * 1000 for _, _, start in batch])
+        for (_, future, _), output in zip(batch, outputs):
+            future.set_result(output)
+
+
+def _handle_line(batcher: MicroBatcher, line: str) -> Future:
+    """
+    a request is a JSON object in the input format of the predictor, or {"command": "stats"}.
+    """
+    future: Future = Future()
+    try:
+        json_dict = json.loads(line)
+    except ValueError as error:
+        future.set_result({'error': f'invalid JSON: {error}'})
+        return future
+    if not isinstance(json_dict, dict):
+        future.set_result({'error': 'a request must be a JSON object'})
+        return future
+    if json_dict.get('command') == 'stats':
+        future.set_result(batcher.statistics())
+        return future
+    return batcher.submit(json_dict)
+
+
+def _handshake(batcher: MicroBatcher) -> str:
+    """
+    the first line written to every client, {"categories": [...]} with the categories
+    that the indices of "head_tags" refer to, which the responses then leave out
+    (nothing for a predictor without categories).
+    """
+    categories = getattr(batcher.predictor, 'categories', None)
+    if categories is None:
+        return ''
+    return json.dumps({'categories': categories()}) + '\n'
+
+
+def _response(future: Future) -> str:
+    try:
+        output = future.result()
+    except Exception as error:  # pylint: disable=broad-except
+        output = {'error': str(error)}
+    # sent once in the handshake
+    output.pop('categories', None)
+    return json.dumps(output) + '\n'
+
+
+def serve_stdio(batcher: MicroBatcher, input_file: TextIO = sys.stdin, output_file: TextIO = sys.stdout) -> None:
+    """
+    reads requests from the lines of input_file and writes the responses in the same order,
+    where the requests read while a batch runs make the next batch.
+    The responses are preceded by the handshake line (see _handshake).
+    """
+    responses: 'queue.Queue[Optional[Future]]' = queue.Queue()
+    output_file.write(_handshake(batcher))
+    output_file.flush()
+
+    def write_responses() -> None:
+        while True:
+            future = responses.get()
+            if future is None:
+                return
+            output_file.write(_response(future))
+            output_file.flush()
+
+    writer = threading.Thread(target=write_responses, name='response-writer', daemon=True)
+    writer.start()
+    for line in input_file:
+        if line.strip():
+            responses.put(_handle_line(batcher, line))
+    responses.put(None)
+    writer.join()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        self.wfile.write(_handshake(self.server.batcher).encode('utf-8'))
+        for line in self.rfile:
+            line = line.decode('utf-8')
+            if line.strip():
+                self.wfile.write(_response(_handle_line(self.server.batcher, line)).encode('utf-8'))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, batcher: MicroBatcher) -> None:
+        super().__init__(socket_path, _RequestHandler)
+        self.batcher = batcher
+
+
+def serve_unix_socket(batcher: MicroBatcher, socket_path: str) -> None:
+    """
+    serves JSON lines requests on a Unix socket, one thread per connection,
+    so that the requests of concurrent clients are batched together.
+    Every connection begins with the handshake line (see _handshake).
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with _UnixServer(socket_path, batcher) as server:
+        logger.info('listening on %s', socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO,
+                        stream=sys.stderr)
+    parser = argparse.ArgumentParser('keep Tree2treePredictor warm and serve JSON lines requests, '
+                                     'on stdin/stdout or on a Unix socket')
+    parser.add_argument('ARCHIVE', help='model.tar.gz')
+    parser.add_argument('--socket', help='path of the Unix socket (stdin/stdout if not given)')
+    parser.add_argument('--predictor', default='tree2tree-compact-predictor')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--cuda-device', type=int, default=-1)
+    parser.add_argument('--cache-directory', help='directory of the cache of the outputs of the model')
+    parser.add_argument('--cache-size-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    # pylint: disable=unused-import,ungrouped-imports
+    from allennlp.models.archival import load_archive
+    from allennlp.predictors.predictor import Predictor
+    import ud2ccg.allennlp.models.tree2tree_export
+    import ud2ccg.allennlp.predictor.tree2tree_predictor
+
+    tree2tree_predictor = Predictor.from_archive(load_archive(args.ARCHIVE, cuda_device=args.cuda_device),
+                                                 args.predictor)
+    if args.cache_directory:
+        tree2tree_predictor.enable_cache(args.cache_directory, args.cache_size_mb)
+    micro_batcher = MicroBatcher(tree2tree_predictor, args.max_batch_size, args.max_wait_ms)
+    if args.socket:
+        serve_unix_socket(micro_batcher, args.socket)
+    else:
+        serve_stdio(micro_batcher)
+    micro_batcher.close()
+    logger.info('statistics: %s', json.dumps(micro_batcher.statistics()))
@@ -0,0 +1,239 @@
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from collections import defaultdict
+
+import torch
+
+from ud2ccg.allennlp.dataset.instance_cache import file_digest
+from ud2ccg.allennlp.dataset.json_stream import iter_json_array, iter_json_lines
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MANIFEST_FILE = 'manifest.json'
+
+# set in the parent process before the workers are forked, so that they share the weights copy-on-write
+_PREDICTOR = None
+
+
+def _shard_file(directory: str, shard: int, kind: str) -> str:
+    return os.path.join(directory, f'{kind}-{shard:05d}.jsonl')
+
+
+def _iter_inputs(input_file: str, json_file: TextIO) -> Iterator[Any]:
+    """
+    the inputs are JSON objects, so that a file (other than .jsonl) is a JSON array
+    if its first non-whitespace character is "[", and JSON lines (e.g. geometry/geo-train.json) otherwise.
+    """
+    if input_file.endswith('.jsonl'):
+        return iter_json_lines(json_file)
+    char = json_file.read(1)
+    while char.isspace():
+        char = json_file.read(1)
+    json_file.seek(0)
+    if char == '[':
+        return iter_json_array(json_file)
+    return iter_json_lines(json_file)
+
+
+def split_input(input_file: str, work_directory: str, sentences_per_shard: int) -> int:
+    """
+    splits input_file (a JSON array or JSON lines in the input format of the predictor,
+    see _iter_inputs) into work_directory/input-XXXXX.jsonl files of sentences_per_shard sentences.
+    The split is recorded in MANIFEST_FILE, and reused when it exists for the same input.
+    :return:
+        number of shards
+    """
+    manifest_file = os.path.join(work_directory, MANIFEST_FILE)
+    digest = file_digest(input_file)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['digest'] != digest or manifest['sentences_per_shard'] != sentences_per_shard:
+            raise ValueError(f'{work_directory} holds shards of another input or split; '
+                             'remove it or choose another work directory')
+        logger.info('resuming from %d shards in %s', manifest['num_shards'], work_directory)
+        return manifest['num_shards']
+
+    os.makedirs(work_directory, exist_ok=True)
+    num_shards, num_sentences = 0, 0
+    shard_file = None
+    with open(input_file) as f:
+        for json_dict in _iter_inputs(input_file, f):
+            if num_sentences % sentences_per_shard == 0:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_file = open(_shard_file(work_directory, num_shards, 'input'), 'w')
+                num_shards += 1
+            shard_file.write(json.dumps(json_dict) + '\n')
+            num_sentences += 1
+    if shard_file is not None:
+        shard_file.close()
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'input': input_file, 'digest': digest, 'sentences_per_shard': sentences_per_shard,
+                   'num_shards': num_shards, 'num_sentences': num_sentences}, f)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    logger.info('split %d sentences of %s into %d shards', num_sentences, input_file, num_shards)
+    return num_shards
+
+
+def _init_worker(threads_per_worker: int) -> None:
+    torch.set_num_threads(threads_per_worker)
+
+
+def _predict_shard(args: Tuple[int, str, int]) -> Tuple[int, int, float, int, Optional[Dict[str, Any]]]:
+    """
+    predicts a shard into work_directory/output-XXXXX.jsonl, which is written to a temporary file
+    and renamed when complete, so that it is the checkpoint of the shard.
+    :return:
+        shard, number of sentences, seconds, the pid of the worker and the statistics of its cache
+    """
+    shard, work_directory, batch_size = args
+    start = time.time()
+    output_file = _shard_file(work_directory, shard, 'output')
+    # in the compact format, every shard begins with its own line of categories
+    _PREDICTOR._categories_written = False  # pylint: disable=protected-access
+    num_sentences = 0
+    with open(_shard_file(work_directory, shard, 'input')) as f, open(output_file + '.tmp', 'w') as out:
+        batch: List[Dict[str, Any]] = []
+        for json_dict in iter_json_lines(f):
+            batch.append(json_dict)
+            if len(batch) == batch_size:
+                for output in _PREDICTOR.predict_batch_json(batch):
+                    out.write(_PREDICTOR.dump_line(output))
+                num_sentences += len(batch)
+                batch = []
+        if batch:
+            for output in _PREDICTOR.predict_batch_json(batch):
+                out.write(_PREDICTOR.dump_line(output))
+            num_sentences += len(batch)
+    os.rename(output_file + '.tmp', output_file)
+    return shard, num_sentences, time.time() - start, os.getpid(), _PREDICTOR.cache_statistics()
+
+
+def _is_categories_line(line: str) -> bool:
+    return line.startswith('{"categories"') and list(json.loads(line)) == ['categories']
+
+
+def merge_outputs(work_directory: str, num_shards: int, output_file: str) -> None:
+    """
+    concatenates the outputs of the shards in the input order, keeping only the first line
+    of categories in the compact format.
+    """
+    categories_written = False
+    with open(output_file, 'w') as out:
+        for shard in range(num_shards):
+            with open(_shard_file(work_directory, shard, 'output')) as f:
+                for i, line in enumerate(f):
+                    if i == 0 and _is_categories_line(line):
+                        if categories_written:
+                            continue
+                        categories_written = True
+                    out.write(line)
+
+
+def predict_in_parallel(archive_file: str,
+                        input_file: str,
+                        output_file: str,
+                        work_directory: Optional[str] = None,
+                        predictor_name: str = 'tree2tree-predictor',
+                        num_workers: int = None,
+                        threads_per_worker: int = 1,
+                        sentences_per_shard: int = 1000,
+                        batch_size: int = 32,
+                        keep_shards: bool = False,
+                        cache_directory: Optional[str] = None,
+                        cache_size_mb: int = 1024) -> None:
+    """
+    runs a predictor over input_file with num_workers CPU processes, which share the weights
+    of the model loaded once in this process (copy-on-write after fork).
+    The input is split into shards (see split_input), the outputs of the shards are written
+    as checkpoints in work_directory, and they are merged in the input order into output_file.
+    When rerun after a crash, the finished shards are not predicted again.
+    :param work_directory: directory of the shards (output_file + '.shards' by default)
+    :param num_workers: number of worker processes (the number of CPUs by default)
+    :param threads_per_worker: number of torch threads of each worker
+    :param keep_shards: keep work_directory after the outputs are merged
+    :param cache_directory: if given, the predictor caches the outputs of the model there (shared by the workers,
+        only for models without legacy_tree_leaf_bias)
+    :param cache_size_mb: size bound of the cache
+    """
+    # pylint: disable=unused-import,global-statement
+    from allennlp.models.archival import load_archive
+    from allennlp.predictors.predictor import Predictor
+    import ud2ccg.allennlp.models.tree2tree_export
+    import ud2ccg.allennlp.predictor.tree2tree_predictor
+
+    global _PREDICTOR
+    work_directory = work_directory or output_file + '.shards'
+    num_workers = num_workers or os.cpu_count()
+    num_shards = split_input(input_file, work_directory, sentences_per_shard)
+    pending = [shard for shard in range(num_shards)
+               if not os.path.exists(_shard_file(work_directory, shard, 'output'))]
+    if len(pending) < num_shards:
+        logger.info('%d of %d shards are already predicted', num_shards - len(pending), num_shards)
+
+    if pending:
+        _PREDICTOR = Predictor.from_archive(load_archive(archive_file), predictor_name)
+        if cache_directory is not None:
+            _PREDICTOR.enable_cache(cache_directory, cache_size_mb)
+        worker_cache_statistics: Dict[int, Dict[str, Any]] = {}
+        start = time.time()
+        worker_sentences: Dict[int, int] = defaultdict(int)
+        worker_seconds: Dict[int, float] = defaultdict(float)
+        context = multiprocessing.get_context('fork')
+        with context.Pool(min(num_workers, len(pending)), _init_worker, (threads_per_worker,)) as pool:
+            tasks = [(shard, work_directory, batch_size) for shard in pending]
+            for done, (shard, num_sentences, seconds, pid, cache_statistics) in enumerate(
+                    pool.imap_unordered(_predict_shard, tasks), 1):
+                if cache_statistics is not None:
+                    worker_cache_statistics[pid] = cache_statistics
+                worker_sentences[pid] += num_sentences
+                worker_seconds[pid] += seconds
+                logger.info('shard %d (%d/%d): %d sentences in %.1fs (%.1f sentences/s) by worker %d',
+                            shard, done, len(pending), num_sentences, seconds,
+                            num_sentences / max(seconds, 1e-6), pid)
+        elapsed = time.time() - start
+        for pid in sorted(worker_sentences):
+            logger.info('worker %d: %d sentences in %.1fs (%.1f sentences/s)', pid, worker_sentences[pid],
+                        worker_seconds[pid], worker_sentences[pid] / max(worker_seconds[pid], 1e-6))
+        total = sum(worker_sentences.values())
+        logger.info('%d sentences in %.1fs with %d workers (%.1f sentences/s)',
+                    total, elapsed, len(worker_sentences), total / max(elapsed, 1e-6))
+        if worker_cache_statistics:
+            hits = sum(statistics['hits'] for statistics in worker_cache_statistics.values())
+            misses = sum(statistics['misses'] for statistics in worker_cache_statistics.values())
+            logger.info('prediction cache: %d hits, %d misses (hit rate %.1f%%)',
+                        hits, misses, 100 * hits / max(hits + misses, 1))
+
+    merge_outputs(work_directory, num_shards, output_file)
+    logger.info('merged %d shards into %s', num_shards, output_file)
+    if not keep_shards:
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser('run Tree2treePredictor with multiple processes over shards of the input')
+    parser.add_argument('ARCHIVE', help='model.tar.gz')
+    parser.add_argument('INPUT', help='JSON array or JSON lines in the input format of the predictor')
+    parser.add_argument('OUTPUT', help='output file')
+    parser.add_argument('--work-directory', help='directory of the shards (OUTPUT.shards by default)')
+    parser.add_argument('--predictor', default='tree2tree-predictor')
+    parser.add_argument('--num-workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--sentences-per-shard', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--keep-shards', action='store_true')
+    parser.add_argument('--cache-directory', help='directory of the cache of the outputs of the model')
+    parser.add_argument('--cache-size-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    predict_in_parallel(args.ARCHIVE, args.INPUT, args.OUTPUT, args.work_directory, args.predictor,
+                        args.num_workers, args.threads_per_worker, args.sentences_per_shard,
+                        args.batch_size, args.keep_shards, args.cache_directory, args.cache_size_mb)
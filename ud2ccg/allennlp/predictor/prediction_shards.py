@@ -0,0 +1,251 @@
+from typing import Iterator, List, NamedTuple, Sequence
+import argparse
+import bisect
+import json
+import logging
+import os
+
+import numpy
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CATEGORIES_FILE = 'categories.json'
+# columns of the index of a shard, where the offsets of heads and head_tags are in elements
+# and those of words in bytes.
+INDEX_COLUMNS = ['length', 'heads_offset', 'head_tags_offset', 'words_offset', 'words_size']
+
+
+class Prediction(NamedTuple):
+    """
+    words: the words of a sentence
+    heads: (sentence length, sentence length + 1) log probabilities
+    head_tags: (sentence length, number of categories) log probabilities
+    """
+    words: List[str]
+    heads: numpy.ndarray
+    head_tags: numpy.ndarray
+
+
+def _shard_file(directory: str, shard: int, kind: str) -> str:
+    return os.path.join(directory, f'shard-{shard:05d}.{kind}')
+
+
+class PredictionShardWriter:
+    """
+    writes predictions into a directory of binary shards, each of which consists of
+    shard-XXXXX.heads, shard-XXXXX.head_tags: raw arrays of the scores of the sentences, concatenated
+    shard-XXXXX.words: the sentences, one per line
+    shard-XXXXX.index.npy: (number of sentences, len(INDEX_COLUMNS)) int64 array
+    along with CATEGORIES_FILE, which holds the categories and the dtype of the scores.
+    The index of a shard is written when the shard is full or closed, so that the shards
+    without an index (e.g. of an interrupted run) are ignored by PredictionShardReader.
+    :param directory: output directory
+    :param categories: the categories indexed by the last dimension of head_tags
+    :param dtype: dtype of the scores, float16 or float32
+    :param sentences_per_shard: number of sentences in a shard
+    """
+    def __init__(self,
+                 directory: str,
+                 categories: List[str],
+                 dtype: str = 'float16',
+                 sentences_per_shard: int = 100000) -> None:
+        self.directory = directory
+        self.categories = categories
+        self.dtype = numpy.dtype(dtype)
+        self.sentences_per_shard = sentences_per_shard
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, CATEGORIES_FILE), 'w') as f:
+            json.dump({'categories': categories, 'dtype': self.dtype.name}, f)
+        self._shard = 0
+        self._files = None
+        self._index: List[List[int]] = []
+        self._offsets = [0, 0, 0]
+
+    def write(self, words: List[str], heads: numpy.ndarray, head_tags: numpy.ndarray) -> None:
+        """
+        :param words: the words of a sentence
+        :param heads: at least (sentence length, sentence length + 1); padding is trimmed
+        :param head_tags: at least (sentence length, number of categories); padding is trimmed
+        """
+        length = len(words)
+        heads = numpy.ascontiguousarray(heads[:length, :length + 1], dtype=self.dtype)
+        head_tags = numpy.ascontiguousarray(head_tags[:length], dtype=self.dtype)
+        if heads.shape != (length, length + 1) or head_tags.shape != (length, len(self.categories)):
+            raise ValueError(f'scores of shapes {heads.shape} and {head_tags.shape} do not match '
+                             f'a sentence of {length} words and {len(self.categories)} categories')
+        if self._files is None:
+            self._files = [open(_shard_file(self.directory, self._shard, kind), 'wb')
+                           for kind in ['heads', 'head_tags', 'words']]
+        sentence = (' '.join(words) + '\n').encode('utf-8')
+        heads_offset, head_tags_offset, words_offset = self._offsets
+        self._index.append([length, heads_offset, head_tags_offset, words_offset, len(sentence) - 1])
+        heads_file, head_tags_file, words_file = self._files
+        heads.tofile(heads_file)
+        head_tags.tofile(head_tags_file)
+        words_file.write(sentence)
+        self._offsets = [heads_offset + heads.size, head_tags_offset + head_tags.size, words_offset + len(sentence)]
+        if len(self._index) == self.sentences_per_shard:
+            self._close_shard()
+
+    def _close_shard(self) -> None:
+        if self._files is None:
+            return
+        for f in self._files:
+            f.close()
+        numpy.save(_shard_file(self.directory, self._shard, 'index.npy'),
+                   numpy.array(self._index, dtype=numpy.int64).reshape(-1, len(INDEX_COLUMNS)))
+        logger.info('wrote %d sentences to shard %d of %s', len(self._index), self._shard, self.directory)
+        self._shard += 1
+        self._files = None
+        self._index = []
+        self._offsets = [0, 0, 0]
+
+    def close(self) -> None:
+        self._close_shard()
+
+    def __enter__(self) -> 'PredictionShardWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _memmap(file_path: str, dtype: numpy.dtype) -> numpy.ndarray:
+    # numpy.memmap cannot map an empty file
+    if os.path.getsize(file_path) == 0:
+        return numpy.empty(0, dtype=dtype)
+    return numpy.memmap(file_path, dtype=dtype, mode='r')
+
+
+class PredictionShardReader(Sequence[Prediction]):
+    """
+    random access to the sentences written by PredictionShardWriter, where the scores
+    are read-only views of memory-mapped shards (without copies).
+    :param directory: directory written by PredictionShardWriter
+    """
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, CATEGORIES_FILE)) as f:
+            meta = json.load(f)
+        self.categories: List[str] = meta['categories']
+        self.dtype = numpy.dtype(meta['dtype'])
+        self._shards = []
+        self._starts = [0]
+        shard = 0
+        while os.path.exists(_shard_file(directory, shard, 'index.npy')):
+            index = numpy.load(_shard_file(directory, shard, 'index.npy'))
+            self._shards.append((index,
+                                 _memmap(_shard_file(directory, shard, 'heads'), self.dtype),
+                                 _memmap(_shard_file(directory, shard, 'head_tags'), self.dtype),
+                                 _memmap(_shard_file(directory, shard, 'words'), numpy.uint8)))
+            self._starts.append(self._starts[-1] + len(index))
+            shard += 1
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'sentence {i} out of range ({len(self)} sentences)')
+        shard = bisect.bisect_right(self._starts, i) - 1
+        index, heads, head_tags, words = self._shards[shard]
+        length, heads_offset, head_tags_offset, words_offset, words_size = index[i - self._starts[shard]].tolist()
+        return Prediction(
+            words=words[words_offset:words_offset + words_size].tobytes().decode('utf-8').split(' '),
+            heads=heads[heads_offset:heads_offset + length * (length + 1)].reshape(length, length + 1),
+            head_tags=head_tags[head_tags_offset:head_tags_offset + length * len(self.categories)]
+            .reshape(length, len(self.categories)))
+
+    def __iter__(self) -> Iterator[Prediction]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def convert_json(json_file: str, directory: str, dtype: str = 'float16', sentences_per_shard: int = 100000) -> None:
+    """
+    converts the output of Tree2treePredictor (JSON lines with "words", "categories",
+    "heads", "heads_shape", "head_tags" and "head_tags_shape") into shards.
+    """
+    writer = None
+    with open(json_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            if 'heads_shape' not in output:
+                raise ValueError(f'{json_file} is not in the full output format of Tree2treePredictor')
+            if writer is None:
+                writer = PredictionShardWriter(directory, output['categories'], dtype, sentences_per_shard)
+            writer.write(output['words'].split(' '),
+                         numpy.array(output['heads'], dtype=writer.dtype).reshape(output['heads_shape']),
+                         numpy.array(output['head_tags'], dtype=writer.dtype).reshape(output['head_tags_shape']))
+    if writer is not None:
+        writer.close()
+
+
+def predict_to_shards(archive_file: str,
+                      input_file: str,
+                      directory: str,
+                      predictor_name: str = 'tree2tree-predictor',
+                      batch_size: int = 32,
+                      cuda_device: int = -1,
+                      dtype: str = 'float16',
+                      sentences_per_shard: int = 100000) -> None:
+    """
+    runs a predictor on input_file (JSON lines in its input format) and writes the predictions into shards.
+    """
+    # pylint: disable=unused-import
+    from allennlp.models.archival import load_archive
+    from allennlp.predictors.predictor import Predictor
+    import ud2ccg.allennlp.models.tree2tree_export
+    import ud2ccg.allennlp.predictor.tree2tree_predictor
+
+    predictor = Predictor.from_archive(load_archive(archive_file, cuda_device=cuda_device), predictor_name)
+    batch = []
+
+    def flush(writer: PredictionShardWriter) -> None:
+        for output in predictor.predict_batch_arrays(batch):
+            writer.write(output['words'], output['heads'], output['head_tags'])
+        batch.clear()
+
+    with PredictionShardWriter(directory, predictor.categories(), dtype, sentences_per_shard) as writer, \
+            open(input_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(predictor._json_to_instance(json.loads(line)))  # pylint: disable=protected-access
+            if len(batch) == batch_size:
+                flush(writer)
+        if batch:
+            flush(writer)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser('write predictions of Tree2TreeBiTreeLSTM as binary shards')
+    subparsers = parser.add_subparsers(dest='command')
+    predict_parser = subparsers.add_parser('predict')
+    predict_parser.add_argument('ARCHIVE', help='model.tar.gz')
+    predict_parser.add_argument('INPUT', help='JSON lines in the input format of the predictor')
+    predict_parser.add_argument('OUTPUT', help='output directory')
+    predict_parser.add_argument('--predictor', default='tree2tree-predictor')
+    predict_parser.add_argument('--batch-size', type=int, default=32)
+    predict_parser.add_argument('--cuda-device', type=int, default=-1)
+    convert_parser = subparsers.add_parser('convert')
+    convert_parser.add_argument('INPUT', help='JSON lines written by Tree2treePredictor')
+    convert_parser.add_argument('OUTPUT', help='output directory')
+    for subparser in [predict_parser, convert_parser]:
+        subparser.add_argument('--dtype', choices=['float16', 'float32'], default='float16')
+        subparser.add_argument('--sentences-per-shard', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == 'predict':
+        predict_to_shards(args.ARCHIVE, args.INPUT, args.OUTPUT, args.predictor, args.batch_size,
+                          args.cuda_device, args.dtype, args.sentences_per_shard)
+    elif args.command == 'convert':
+        convert_json(args.INPUT, args.OUTPUT, args.dtype, args.sentences_per_shard)
+    else:
+        parser.print_help()
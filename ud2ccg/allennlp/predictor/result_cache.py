@@ -0,0 +1,161 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import torch
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+USAGE_FILE = 'usage.json'
+LOCK_FILE = 'lock'
+# fraction of max_bytes that an eviction leaves, so that the directory is not scanned at every put
+EVICTION_TARGET = 0.9
+
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    """
+    :return:
+        a digest of the weights of model (their names, shapes, dtypes and values),
+        which identifies the archive it is loaded from
+    """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype};'.encode('utf-8'))
+        digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b'')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    content-addressed on-disk store of picklable values, where the key is a hex digest
+    (e.g. sha1 of the input) and the value is stored at directory/key[:2]/key.pkl.
+    The store can be shared by processes (e.g. the workers of parallel_predict): its total size
+    and number of entries are kept in directory/USAGE_FILE, which is only updated under
+    an exclusive lock of directory/LOCK_FILE, so that max_bytes bounds the store of all of them.
+    When the total size exceeds max_bytes, the least recently used files are evicted down to
+    EVICTION_TARGET * max_bytes, and the usage is recomputed from a scan of the directory.
+    The recency is the modification time of the files, updated at every hit, so that it is kept across runs.
+    :param directory: directory of the store
+    :param max_bytes: size bound of the store
+    """
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # the usage file may be stale after a crash
+        with self._locked():
+            entries = self._scan()
+            self._write_usage(sum(size for _, _, size in entries), len(entries))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.pkl')
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        # the lock file is opened at every call, as a flock lock is held by an open file,
+        # which forked processes would share
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _scan(self) -> List[Tuple[float, str, int]]:
+        """
+        :return:
+            the modification time, path and size of each file of the store, from the least recently used
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*', '*.pkl')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        return sorted(entries)
+
+    def _read_usage(self) -> Tuple[int, int]:
+        """
+        :return:
+            total size and number of entries of the store
+        """
+        with open(os.path.join(self.directory, USAGE_FILE)) as f:
+            usage = json.load(f)
+        return usage['bytes'], usage['entries']
+
+    def _write_usage(self, total_bytes: int, entries: int) -> None:
+        usage_file = os.path.join(self.directory, USAGE_FILE)
+        with open(f'{usage_file}.{os.getpid()}.tmp', 'w') as f:
+            json.dump({'bytes': total_bytes, 'entries': entries}, f)
+        os.rename(f'{usage_file}.{os.getpid()}.tmp', usage_file)
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        with self._locked():
+            total_bytes, entries = self._read_usage()
+            try:
+                total_bytes -= os.stat(path).st_size
+            except FileNotFoundError:
+                entries += 1
+            os.rename(temporary_path, path)
+            total_bytes += size
+            if total_bytes > self.max_bytes:
+                total_bytes, entries = self._evict()
+            self._write_usage(total_bytes, entries)
+
+    def _evict(self) -> Tuple[int, int]:
+        """
+        evicts the least recently used files down to EVICTION_TARGET * max_bytes (under the lock)
+        :return:
+            total size and number of entries of the store after the eviction
+        """
+        entries = self._scan()
+        total_bytes = sum(size for _, _, size in entries)
+        target_bytes = EVICTION_TARGET * self.max_bytes
+        evicted = 0
+        # the last one, which has just been put, is kept
+        while total_bytes > target_bytes and evicted < len(entries) - 1:
+            _, path, size = entries[evicted]
+            os.remove(path)
+            total_bytes -= size
+            evicted += 1
+        self.evictions += evicted
+        return total_bytes, len(entries) - evicted
+
+    def statistics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        total_bytes, entries = self._read_usage()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'entries': entries,
+                'megabytes': total_bytes / (1 << 20)}
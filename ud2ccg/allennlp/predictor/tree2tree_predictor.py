@@ -1,4 +1,7 @@
 from typing import Dict, Optional, Tuple, Any, List
+import atexit
+import hashlib
+import json
 import logging
 import copy
 
@@ -6,22 +9,131 @@ from overrides import overrides
 import torch
 from torch.nn.modules import Dropout
 import numpy
+from allennlp.common.checks import ConfigurationError
 from allennlp.common.util import JsonDict, sanitize
 from allennlp.data import DatasetReader, Instance
 from allennlp.models import Model
 from allennlp.predictors.predictor import Predictor
 import allennlp.predictors.predictor as predictor
 from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN
-from utils import denormalize
+from ud2ccg.allennlp.data.tree_cost_iterator import group_by_tree_cost, tree_cost
+from ud2ccg.allennlp.predictor.result_cache import ResultCache, model_fingerprint
 
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+def top_k_heads(heads: numpy.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+    """
+    :param heads: (sentence length, sentence length + 1) log probabilities
+    :return:
+        for each token, at most k pairs of a head index and its log probability, best first
+    """
+    k = min(k, heads.shape[1])
+    best = numpy.argsort(-heads, axis=1, kind='stable')[:, :k]
+    return [[(int(head), float(scores[head])) for head in token_best if numpy.isfinite(scores[head])]
+            for scores, token_best in zip(heads, best)]
+
+
+def beta_pruned_tags(head_tags: numpy.ndarray, beta: float) -> List[List[Tuple[int, float]]]:
+    """
+    :param head_tags: (sentence length, number of categories) log probabilities
+    :param beta: categories whose probabilities are less than beta times the best are pruned
+    :return:
+        for each token, pairs of a category index and its log probability, best first
+    """
+    threshold = head_tags.max(axis=1, keepdims=True) + numpy.log(beta)
+    results = []
+    for scores, token_threshold in zip(head_tags, threshold):
+        kept = numpy.flatnonzero(scores >= token_threshold)
+        kept = kept[numpy.argsort(-scores[kept], kind='stable')]
+        results.append([(int(category), float(scores[category])) for category in kept])
+    return results
+
+
+def batch_dependent(model: Model) -> bool:
+    """
+    :return:
+        whether the scores of a sentence depend on the other sentences in its batch, as those of
+        a Tree2TreeBiTreeLSTM with legacy_tree_leaf_bias (see BidirectionalTreeLSTM) do
+    """
+    tree_encoder = getattr(model, 'tree_encoder', None)
+    return getattr(getattr(tree_encoder, 'encoder', None), 'legacy_leaf_bias', False)
+
+
 @Predictor.register('tree2tree-predictor')
 class Tree2treePredictor(Predictor):
-    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
+    """
+    :param compact: if True, output only the top head_top_k heads and the categories within beta
+        of the best for each token, as lists of [index, log probability], and write the category list
+        once as the first line of the output instead of in every sentence
+    :param max_tokens: if given, the instances of a batch are sorted by their tree costs and run in
+        sub-batches of at most max_tokens of batch size * (sentence length + 1), so that short sentences
+        are not padded to the longest one in the batch; the outputs are in the input order.
+        The non-compact "heads" and "head_tags" (and their shapes) are then padded to the longest
+        sentence of the sub-batch instead of the batch. With a model whose scores depend on the other
+        sentences in the batch (legacy_tree_leaf_bias of Tree2TreeBiTreeLSTM), the scores change too.
+    :param max_arc_cells: optional budget of batch size * (sentence length + 1) ** 2 of the sub-batches
+    :param cache_directory: if given, the outputs of the model are cached there
+        (see enable_cache, only for models without legacy_tree_leaf_bias)
+    :param cache_size_mb: size bound of the cache
+    """
+    def __init__(self,
+                 model: Model,
+                 dataset_reader: DatasetReader,
+                 compact: bool = False,
+                 head_top_k: int = 5,
+                 beta: float = 0.00001,
+                 max_tokens: Optional[int] = None,
+                 max_arc_cells: Optional[int] = None,
+                 cache_directory: Optional[str] = None,
+                 cache_size_mb: int = 1024) -> None:
         super().__init__(model, dataset_reader)
+        self._compact = compact
+        self._head_top_k = head_top_k
+        self._beta = beta
+        self._max_tokens = max_tokens
+        if max_tokens is not None and batch_dependent(model):
+            logger.warning('the scores of the model depend on the batch (legacy_tree_leaf_bias), '
+                           'so they change when batches are split by max_tokens')
+        self._max_arc_cells = max_arc_cells
+        self._categories_written = False
+        self._cache: Optional[ResultCache] = None
+        self._model_fingerprint: Optional[str] = None
+        if cache_directory is not None:
+            self.enable_cache(cache_directory, cache_size_mb)
+
+    def enable_cache(self, directory: str, size_mb: int = 1024) -> None:
+        """
+        caches the outputs of the model in an on-disk store (ResultCache) keyed by a digest of
+        the words, UD heads, tags and labels, the metadata of an instance and the weights of the model,
+        so that the instances seen before skip the model. The statistics are logged at exit.
+        A sentence is cached on its own, so that the cache is only for models whose scores
+        do not depend on the other sentences in the batch, i.e. not with legacy_tree_leaf_bias
+        of Tree2TreeBiTreeLSTM (see batch_dependent), for which it raises ConfigurationError.
+        """
+        if batch_dependent(self._model):
+            raise ConfigurationError('the prediction cache cannot be used with a model whose scores depend '
+                                     'on the batch (a Tree2TreeBiTreeLSTM with legacy_tree_leaf_bias)')
+        if self._cache is None:
+            atexit.register(self._log_cache_statistics)
+        self._cache = ResultCache(directory, size_mb << 20)
+        self._model_fingerprint = model_fingerprint(self._model)
+
+    def cache_statistics(self) -> Optional[Dict[str, Any]]:
+        return self._cache.statistics() if self._cache is not None else None
+
+    def _log_cache_statistics(self) -> None:
+        logger.info('prediction cache at %s: %s', self._cache.directory, json.dumps(self._cache.statistics()))
+
+    def _cache_key(self, instance: Instance) -> str:
+        fields = instance.fields
+        key = [self._model_fingerprint,
+               fields['ud_head_index_field'].array.tolist(),
+               [token.text for token in fields['ud_tag_field'].tokens],
+               [token.text for token in fields['ud_label_field'].tokens],
+               fields['metadata'].metadata]
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
     def predict(self, sentence: str) -> JsonDict:
         raise NotImplementedError('no support for inference on a raw sentence.')
@@ -36,40 +148,193 @@ class Tree2treePredictor(Predictor):
 
     @overrides
     def predict_instance(self, instance: Instance) -> JsonDict:
-        outputs = self._model.forward_on_instance(instance)
-        [result] = self._make_json([outputs])
-        return result
+        outputs = self._forward_on_instances([instance])
+        return self._make_json(outputs)[0]
 
     @overrides
     def predict_batch_instance(self, instances: List[Instance]) -> List[JsonDict]:
-        outputs = self._model.forward_on_instances(instances)
+        outputs = self._forward_on_instances(instances)
         return self._make_json(outputs)
 
-    def _make_json(self, output_dicts: List[Dict[str, Any]]) -> List[JsonDict]:
+    def _forward_on_instances(self, instances: List[Instance]) -> List[Dict[str, Any]]:
+        """
+        outputs of the model on instances, from the cache if enabled and otherwise from _run_model
+        """
+        if self._cache is None:
+            return self._run_model(instances)
+        keys = [self._cache_key(instance) for instance in instances]
+        outputs = [self._cache.get(key) for key in keys]
+        # repeated instances in the batch run once
+        missing: Dict[str, List[int]] = {}
+        for index, output in enumerate(outputs):
+            if output is None:
+                missing.setdefault(keys[index], []).append(index)
+        if missing:
+            model_outputs = self._run_model([instances[indices[0]] for indices in missing.values()])
+            for (key, indices), output in zip(missing.items(), model_outputs):
+                # stored before the output is modified by _make_json
+                self._cache.put(key, output)
+                outputs[indices[0]] = output
+                for index in indices[1:]:
+                    outputs[index] = copy.deepcopy(output)
+        return outputs
+
+    def _run_model(self, instances: List[Instance]) -> List[Dict[str, Any]]:
+        """
+        model.forward_on_instances in sub-batches under max_tokens (and max_arc_cells),
+        where the outputs of each sub-batch are padded to its longest sentence.
+        """
+        if self._max_tokens is None or len(instances) <= 1:
+            return self._model.forward_on_instances(instances)
+        batches = group_by_tree_cost([tree_cost(instance) for instance in instances],
+                                     self._max_tokens,
+                                     max_arc_cells=self._max_arc_cells)
+        outputs: List[Optional[Dict[str, Any]]] = [None] * len(instances)
+        for batch in batches:
+            batch_outputs = self._model.forward_on_instances([instances[index] for index in batch])
+            for index, output in zip(batch, batch_outputs):
+                outputs[index] = output
+        return outputs
+
+    def predict_batch_arrays(self, instances: List[Instance]) -> List[Dict[str, Any]]:
+        """
+        same as predict_batch_instance, but "heads" and "head_tags" stay numpy arrays
+        (padded to the longest sentence in the batch, or in the sub-batch with max_tokens),
+        and "words" a list of words.
+        The categories are those of categories().
+        """
+        outputs = self._forward_on_instances(instances)
+        return self._make_arrays(outputs, self.categories())
+
+    def categories(self) -> List[str]:
+        """
+        :return:
+            the categories indexed by the last dimension of "head_tags"
+        """
         categories = self._model.vocab.get_index_to_token_vocabulary('head_tags')
         categories = [token for _, token in sorted(categories.items())]
         categories, paddings = categories[2:], categories[:2]
         assert all(padding in [DEFAULT_PADDING_TOKEN, DEFAULT_OOV_TOKEN] for padding in paddings)
+        return categories
 
+    def _make_arrays(self, output_dicts: List[Dict[str, Any]], categories: List[str]) -> List[Dict[str, Any]]:
         for output_dict in output_dicts:
+            assert output_dict["head_tags"].shape[-1] == len(categories)
+        return output_dicts
+
+    def _make_json(self, output_dicts: List[Dict[str, Any]]) -> List[JsonDict]:
+        categories = self.categories()
+        for output_dict in self._make_arrays(output_dicts, categories):
+            self._set_scores(output_dict, categories)
+        return output_dicts
+
+    def _set_scores(self, output_dict: Dict[str, Any], categories: List[str]) -> None:
+        words = output_dict["words"]
+        heads = output_dict["heads"]
+        head_tags = output_dict["head_tags"]
+        if self._compact:
+            # the outputs are padded to the longest sentence in the sub-batch
+            length = len(words)
+            output_dict["heads"] = top_k_heads(heads[:length, :length + 1], self._head_top_k)
+            output_dict["head_tags"] = beta_pruned_tags(head_tags[:length], self._beta)
+            output_dict["categories"] = categories
+        else:
             output_dict['categories'] = categories
-            head_tags = output_dict["head_tags"]
-            assert head_tags.shape[-1] == len(categories)
-            heads = output_dict["heads"]
             output_dict["head_tags"] = head_tags.flatten().astype(float).tolist()
             output_dict["heads"] = heads.flatten().astype(float).tolist()
             output_dict["head_tags_shape"] = list(head_tags.shape)
             output_dict["heads_shape"] = list(heads.shape)
-            output_dict["words"] = ' '.join(output_dict["words"])
-            output_dict.pop("loss")
-            output_dict.pop("mask")
-        return output_dicts
+        output_dict["words"] = ' '.join(words)
+        output_dict.pop("loss", None)
+        output_dict.pop("mask")
+
+    @overrides
+    def dump_line(self, outputs: JsonDict) -> str:
+        if not self._compact:
+            return super().dump_line(outputs)
+        categories = outputs.pop("categories")
+        line = super().dump_line(outputs)
+        if not self._categories_written:
+            self._categories_written = True
+            line = super().dump_line({"categories": categories}) + line
+        return line
+
+
+def remap_disfluencies(heads: List[numpy.ndarray],
+                       head_tags: List[numpy.ndarray],
+                       edits: List[List[int]]) -> Tuple[List[numpy.ndarray], List[numpy.ndarray]]:
+    """
+    maps the scores of the fluent tokens of a batch of sentences onto the original sentences,
+    in one allocation for the whole batch, with the indices of the fluent tokens computed at once.
+    Disfluent tokens are tagged with the category appended last ('X')
+    and attached to the previous word, and the first fluent token after initial disfluencies
+    is attached to the last of them.
+    :param heads: (number of fluent tokens, number of fluent tokens + 1) log probabilities of each sentence
+    :param head_tags: (number of fluent tokens, number of categories) log probabilities of each sentence
+    :param edits: for each token of each original sentence, whether it is disfluent
+    :return:
+        heads: (sentence length, sentence length + 1) log probabilities of each sentence
+        head_tags: (sentence length, number of categories + 1) log probabilities of each sentence
+        (views of flat arrays of the whole batch)
+    """
+    lengths = numpy.array([len(sentence_edits) for sentence_edits in edits])
+    token_offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+    cell_offsets = numpy.concatenate([[0], numpy.cumsum(lengths * (lengths + 1))])
+    disfluent = numpy.concatenate([numpy.asarray(sentence_edits, dtype=bool) for sentence_edits in edits])
+    sentence_of_token = numpy.repeat(numpy.arange(len(edits)), lengths)
+    position = numpy.arange(len(disfluent)) - token_offsets[sentence_of_token]
+    fluent_tokens = numpy.flatnonzero(~disfluent)
+    fluent_offsets = numpy.searchsorted(fluent_tokens, token_offsets)
+
+    # the scores of the whole batch in one allocation
+    new_heads = numpy.full(cell_offsets[-1], -numpy.inf, 'f')
+    new_head_tags = numpy.full((len(disfluent), head_tags[0].shape[-1] + 1), -numpy.inf, 'f')
+    if len(fluent_tokens) > 0:
+        new_head_tags[fluent_tokens, :-1] = numpy.concatenate(head_tags)
+    new_head_tags[disfluent, -1] = 0.0  # log prob 0 for category 'X'
+    sentence_heads = [new_heads[cell_offsets[i]:cell_offsets[i + 1]].reshape(length, length + 1)
+                      for i, length in enumerate(lengths)]
+    for i, sentence_fluent in enumerate(numpy.split(position[fluent_tokens], fluent_offsets[1:-1])):
+        sentence_heads[i][numpy.ix_(sentence_fluent, numpy.concatenate([[0], sentence_fluent + 1]))] = heads[i]
+
+    # attach disfluencies to the previous word
+    disfluent_tokens = numpy.flatnonzero(disfluent)
+    new_heads[cell_offsets[sentence_of_token[disfluent_tokens]]
+              + position[disfluent_tokens] * (lengths[sentence_of_token[disfluent_tokens]] + 2)] = 0.0
+    # a sentence beginning with disfluencies: attach its first fluent token to the last of them
+    starts = numpy.flatnonzero((lengths > 0) & (fluent_offsets[1:] > fluent_offsets[:-1]))
+    starts = starts[disfluent[token_offsets[starts]]]
+    first_fluent = position[fluent_tokens[fluent_offsets[starts]]]
+    rows = cell_offsets[starts] + first_fluent * (lengths[starts] + 1)
+    new_heads[rows + first_fluent] = 0.0
+    new_heads[rows] = -numpy.inf
+    return sentence_heads, [new_head_tags[start:end] for start, end in zip(token_offsets[:-1], token_offsets[1:])]
 
 
 @Predictor.register('tree2tree-switchboard-predictor')
 class SwitchboardTree2treePredictor(Tree2treePredictor):
-    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
-        super().__init__(model, dataset_reader)
+    """
+    :param sparse: if True, the scores of the disfluent tokens are not materialized:
+        "heads" and "head_tags" are those of the fluent tokens only, whose positions in the original
+        sentence are in "fluent_indices" (column j > 0 of "heads" is the (j - 1)-th fluent token),
+        while the other tokens are tagged 'X' and attached to the previous word.
+        As "head_tags" then has no column for 'X', the categories (of categories() and of
+        the non-compact output) do not include it. The compact output is the same as without sparse.
+    """
+    def __init__(self,
+                 model: Model,
+                 dataset_reader: DatasetReader,
+                 compact: bool = False,
+                 head_top_k: int = 5,
+                 beta: float = 0.00001,
+                 max_tokens: Optional[int] = None,
+                 max_arc_cells: Optional[int] = None,
+                 cache_directory: Optional[str] = None,
+                 cache_size_mb: int = 1024,
+                 sparse: bool = False) -> None:
+        super().__init__(model, dataset_reader, compact, head_top_k, beta, max_tokens, max_arc_cells,
+                         cache_directory, cache_size_mb)
+        self._sparse = sparse
 
     def predict(self, sentence: str) -> JsonDict:
         raise NotImplementedError('no support for inference on a raw sentence.')
@@ -84,84 +349,91 @@ class SwitchboardTree2treePredictor(Tree2treePredictor):
 
     @overrides
     def predict_instance(self, instance: Instance) -> JsonDict:
-        outputs = self._model.forward_on_instance(instance)
-        [result] = self._make_json([outputs])
-        return result
+        outputs = self._forward_on_instances([instance])
+        return self._make_json(outputs)[0]
 
     @overrides
     def predict_batch_instance(self, instances: List[Instance]) -> List[JsonDict]:
-        outputs = self._model.forward_on_instances(instances)
+        outputs = self._forward_on_instances(instances)
         return self._make_json(outputs)
 
-    def _make_json(self, output_dicts: List[Dict[str, Any]]) -> List[JsonDict]:
-        categories = self._model.vocab.get_index_to_token_vocabulary('head_tags')
-        categories = [token for _, token in sorted(categories.items())]
-        categories, paddings = categories[2:], categories[:2]
-        assert all(padding in [DEFAULT_PADDING_TOKEN, DEFAULT_OOV_TOKEN] for padding in paddings)
+    @overrides
+    def categories(self) -> List[str]:
+        # disfluent tokens are tagged with 'X', which only the dense scores have a column for
+        if self._sparse:
+            return super().categories()
+        return super().categories() + ['X']
 
-        categories.append('X')
-        category_size = len(categories)
-        for output_dict in output_dicts:
-            fluent_sentence = output_dict['words']
-            original_sentence = output_dict['original']
-            head_tags = output_dict['head_tags']
-            heads = output_dict['heads']
-            edit_info = output_dict['edits']
-            if not output_dict['contain_disfluency']:
-                assert len(fluent_sentence) == len(original_sentence)
-                new_head_tags = numpy.ones((len(original_sentence), category_size), 'f') * -numpy.inf
-                new_head_tags[:, :-1] = head_tags
-                head_tags = new_head_tags
-            else:
-                if logger.isEnabledFor(logging.DEBUG):
-                    predicted_head_tags = numpy.argmax(head_tags, axis=1)
-                    predicted_heads = numpy.argmax(heads, axis=1)
-                    for i, (word, edit, cat, head) in enumerate(zip(
-                            fluent_sentence, edit_info, predicted_head_tags, predicted_heads), 1):
-                        edit = "1" if edit else "0"
-                        logger.debug(f'{i}\t{word}\t{head}\t{edit}\t{categories[cat]}')
-                    logger.debug('')
-
-                disfl_indices = [i for i, edit in enumerate(edit_info) if edit]
-                fluent_indices = [i for i, edit in enumerate(edit_info) if not edit]
-                assert len(fluent_indices) == len(fluent_sentence), str(fluent_sentence)
-
-                new_head_tags = numpy.ones((len(original_sentence), category_size), 'f') * -numpy.inf
-                new_head_tags[fluent_indices, :-1] = head_tags
-                new_head_tags[disfl_indices, -1] = 0.0  # log prob 0 for category 'X'
-
-                new_heads = numpy.ones((len(original_sentence), len(original_sentence) + 1), 'f') * -numpy.inf
-                new_heads[numpy.ix_(fluent_indices, [0] + [v + 1 for v in fluent_indices])] = heads
-                new_heads[numpy.ix_(fluent_indices, [v + 1 for v in disfl_indices])] = -numpy.inf
-                new_heads[disfl_indices, disfl_indices] = 0.0  # attach disfluencies to previous word
-                if 0 in disfl_indices:
-                    # set this token's head to the last disfluent token before it.
-                    clean0 = fluent_indices[0]
-                    disfl0 = [i for i in disfl_indices if i <= clean0][-1]
-                    new_heads[clean0, disfl0 + 1] = 0.0
-                    new_heads[clean0, 0] = - numpy.inf
-                head_tags = new_head_tags
-                heads = new_heads
-
-                if logger.isEnabledFor(logging.DEBUG):
-                    predicted_head_tags = numpy.argmax(head_tags, axis=1)
-                    predicted_heads = numpy.argmax(heads, axis=1)
-                    for i, (word, edit, cat, head) in enumerate(zip(
-                            original_sentence, edit_info, predicted_head_tags, predicted_heads), 1):
-                        edit = "1" if edit else "0"
-                        logger.debug(f'{i}\t{word}\t{head}\t{edit}\t{categories[cat]}')
-                    logger.debug('')
-
-            assert head_tags.shape[-1] == category_size
-            output_dict['categories'] = categories
-            output_dict["head_tags"] = head_tags.flatten().astype(float).tolist()
-            output_dict["heads"] = heads.flatten().astype(float).tolist()
-            output_dict["head_tags_shape"] = list(head_tags.shape)
-            output_dict["heads_shape"] = list(heads.shape)
-            output_dict["words"] = ' '.join(original_sentence)
-            output_dict.pop("loss")
-            output_dict.pop("mask")
+    @overrides
+    def _make_arrays(self, output_dicts: List[Dict[str, Any]], categories: List[str]) -> List[Dict[str, Any]]:
+        lengths = [len(output_dict['words']) for output_dict in output_dicts]
+        heads = [output_dict['heads'][:length, :length + 1] for output_dict, length in zip(output_dicts, lengths)]
+        head_tags = [output_dict['head_tags'][:length] for output_dict, length in zip(output_dicts, lengths)]
+        edits = [output_dict['edits'] if output_dict['contain_disfluency'] else [0] * len(output_dict['original'])
+                 for output_dict in output_dicts]
+        for output_dict, sentence_edits in zip(output_dicts, edits):
+            assert len(output_dict['words']) == len(sentence_edits) - sum(map(bool, sentence_edits)), \
+                str(output_dict['words'])
+        if not self._sparse:
+            heads, head_tags = remap_disfluencies(heads, head_tags, edits)
+        for i, output_dict in enumerate(output_dicts):
+            output_dict["words"] = output_dict['original']
+            output_dict["heads"] = heads[i]
+            output_dict["head_tags"] = head_tags[i]
+            if self._sparse:
+                output_dict["fluent_indices"] = [j for j, edit in enumerate(edits[i]) if not edit]
+            assert head_tags[i].shape[-1] == len(categories)
+
+        if logger.isEnabledFor(logging.DEBUG) and not self._sparse:
+            for output_dict, sentence_edits in zip(output_dicts, edits):
+                predicted_head_tags = numpy.argmax(output_dict['head_tags'], axis=1)
+                predicted_heads = numpy.argmax(output_dict['heads'], axis=1)
+                for i, (word, edit, cat, head) in enumerate(zip(
+                        output_dict['words'], sentence_edits, predicted_head_tags, predicted_heads), 1):
+                    edit = "1" if edit else "0"
+                    logger.debug(f'{i}\t{word}\t{head}\t{edit}\t{categories[cat]}')
+                logger.debug('')
         return output_dicts
 
+    @overrides
+    def _set_scores(self, output_dict: Dict[str, Any], categories: List[str]) -> None:
+        if not (self._sparse and self._compact):
+            super()._set_scores(output_dict, categories)
+            return
+        # the same lists as the compact output of the dense scores, computed on the fluent tokens only
+        categories = categories + ['X']
+        words = output_dict["words"]
+        fluent_indices = output_dict.pop("fluent_indices")
+        columns = [0] + [index + 1 for index in fluent_indices]
+        heads = [[(i, 0.0)] for i in range(len(words))]
+        head_tags = [[(len(categories) - 1, 0.0)] for _ in words]
+        fluent_heads = top_k_heads(output_dict["heads"], self._head_top_k)
+        fluent_head_tags = beta_pruned_tags(output_dict["head_tags"], self._beta)
+        for index, token_heads, token_head_tags in zip(fluent_indices, fluent_heads, fluent_head_tags):
+            heads[index] = [(columns[head], score) for head, score in token_heads]
+            head_tags[index] = token_head_tags
+        if fluent_indices and fluent_indices[0] > 0:
+            first = fluent_indices[0]
+            heads[first] = ([(first, 0.0)] + [(head, score) for head, score in heads[first] if head != 0])
+            heads[first] = heads[first][:self._head_top_k]
+        output_dict["heads"] = heads
+        output_dict["head_tags"] = head_tags
+        output_dict["categories"] = categories
+        output_dict["words"] = ' '.join(words)
+        output_dict.pop("loss", None)
+        output_dict.pop("mask")
+
+
+@Predictor.register('tree2tree-compact-predictor')
+class CompactTree2treePredictor(Tree2treePredictor):
+    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
+        super().__init__(model, dataset_reader, compact=True)
+
+
+@Predictor.register('tree2tree-switchboard-compact-predictor')
+class CompactSwitchboardTree2treePredictor(SwitchboardTree2treePredictor):
+    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
+        super().__init__(model, dataset_reader, compact=True)
+
 
 predictor.DEFAULT_PREDICTORS['tree2tree_bitreelstm'] = 'tree2tree-predictor'